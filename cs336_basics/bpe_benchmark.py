@@ -0,0 +1,249 @@
+"""
+Scaling benchmark for BPE training.
+
+Generates deterministic synthetic corpora of increasing size by sampling documents from the test fixtures, with a
+share of their words replaced by Zipf-distributed synthetic words so that, like in a real corpus, the number of
+distinct pretokens keeps growing with the size. Times train_bpe on each of them for every combination of vocab size
+and worker count, and writes the results as JSON. Given a baseline from an earlier run, any configuration that got
+slower than the tolerance allows is reported and the process exits with status 1.
+
+    uv run python -m cs336_basics.bpe_benchmark --sizes 1M 16M 256M --vocab-sizes 1000 10000 \\
+        --output bench.json --baseline bench-baseline.json
+
+With --compare-pretokenizers, only the regex stage is timed instead: PAT on every document against the ASCII fast
+path (pretokenize), checking that both produce the same pretokens. Its results can be used as a --baseline for
+later --compare-pretokenizers runs in the same way.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import string
+import sys
+import time
+
+from cs336_basics.instrumentation import Instrumentation
+from cs336_basics.pretokenization import PAT, pretokenize
+from cs336_basics.train_bpe import train_bpe
+
+FIXTURES = ["tinystories_sample.txt", "corpus.en", "german.txt", "address.txt"]
+SPECIAL_TOKENS = ["<|endoftext|>"]
+UNITS = {"K": 2**10, "M": 2**20, "G": 2**30}
+RARE_WORD_RATE = 0.2  # share of the fixture words replaced by synthetic ones
+ZIPF_EXPONENT = 1.2  # of the synthetic word frequencies, distinct words grow about as words ** (1 / ZIPF_EXPONENT)
+
+
+def parse_size(size: str) -> int:
+    """'64M' -> 67108864"""
+    if size[-1].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+    return int(size)
+
+
+def load_documents(fixtures_dir: str) -> list[str]:
+    """Documents to sample from: the fixture files split on <|endoftext|> and blank lines."""
+    documents = []
+    for name in FIXTURES:
+        with open(os.path.join(fixtures_dir, name), encoding="utf-8") as f:
+            text = f.read()
+        for part in text.split("<|endoftext|>"):
+            documents.extend(doc.strip() for doc in part.split("\n\n") if doc.strip())
+    return documents
+
+
+def synthetic_word(rank: int) -> str:
+    """Word number rank of the synthetic vocabulary: a fixed string of 2 to 12 lowercase letters."""
+    rng = random.Random(rank)
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 12)))
+
+
+def make_corpus(path: str, size: int, documents: list[str], seed: int = 0) -> None:
+    """
+    Write about size bytes of documents sampled with a fixed seed, separated by <|endoftext|>. Every word of a
+    sampled document is replaced with probability RARE_WORD_RATE by a synthetic word with a Zipf-distributed
+    rank, so frequent ranks repeat across documents while the long tail keeps adding new words.
+    """
+    rng = random.Random(seed)
+    words = {}
+
+    def replace(match):
+        if rng.random() >= RARE_WORD_RATE:
+            return match.group()
+        # P(rank >= k) ~ k ** -(s - 1) makes the frequency of rank k fall off as k ** -s
+        rank = int(rng.paretovariate(ZIPF_EXPONENT - 1))
+        if rank not in words:
+            words[rank] = synthetic_word(rank)
+        return words[rank]
+
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < size:
+            text = re.sub(r"\w+", replace, rng.choice(documents)) + "\n<|endoftext|>\n"
+            f.write(text)
+            written += len(text.encode("utf-8"))
+
+
+def corpus_path(work_dir: str, size: int, seed: int, documents: list[str]) -> str:
+    """Generate the corpus once and reuse it on later runs, it only depends on size and seed."""
+    path = os.path.join(work_dir, f"zipf-{size}-{seed}.txt")
+    if not os.path.exists(path):
+        make_corpus(f"{path}.tmp", size, documents, seed)
+        os.replace(f"{path}.tmp", path)
+    return path
+
+
+def config_key(result: dict) -> str:
+    return f"size={result['corpus_bytes']} vocab={result['vocab_size']} workers={result['num_processes']}"
+
+
+def run(sizes: list[int], vocab_sizes: list[int], worker_counts: list[int], work_dir: str, fixtures_dir: str, seed: int, repeats: int) -> list[dict]:
+    documents = load_documents(fixtures_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for size in sizes:
+        path = corpus_path(work_dir, size, seed, documents)
+        for num_processes in worker_counts:
+            for vocab_size in vocab_sizes:
+                # keep the fastest of the repeats, it is the least disturbed by whatever else runs on the machine
+                best = None
+                for _ in range(repeats):
+                    instrumentation = Instrumentation()
+                    train_bpe(path, vocab_size, SPECIAL_TOKENS, num_processes=num_processes, instrumentation=instrumentation)
+                    report = instrumentation.report()
+                    if best is None or report["total_seconds"] < best["total_seconds"]:
+                        best = report
+                result = {"corpus_bytes": os.path.getsize(path), "vocab_size": vocab_size, "num_processes": num_processes, **best}
+                print(f"{config_key(result)}: {result['total_seconds']:.2f}s "
+                      f"(merge loop {result['phases']['merge_loop']['seconds']:.2f}s)", file=sys.stderr)
+                results.append(result)
+    return results
+
+
+def merge_loop_scaling(results: list[dict]) -> dict[str, float]:
+    """
+    Log-log slope of merge loop time against corpus size for every (vocab size, workers) pair. A slope below 1
+    means the merge loop grows sub-linearly with the corpus.
+    """
+    series = {}
+    for result in results:
+        key = f"vocab={result['vocab_size']} workers={result['num_processes']}"
+        series.setdefault(key, []).append((result["corpus_bytes"], result["phases"]["merge_loop"]["seconds"]))
+    slopes = {}
+    for key, points in series.items():
+        points = [(math.log(x), math.log(y)) for x, y in points if y > 0]
+        if len(points) < 2:
+            continue
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        var_x = sum((x - mean_x) ** 2 for x, _ in points)
+        if var_x > 0:
+            slopes[key] = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return slopes
+
+
+def pretokenizer_key(result: dict) -> str:
+    return f"size={result['corpus_bytes']}"
+
+
+def find_regressions(results: list[dict], baseline: list[dict], tolerance: float, key=config_key, field: str = "total_seconds") -> list[str]:
+    """Configurations present in both runs whose time (field) grew by more than tolerance (0.1 = 10%)."""
+    baseline_by_key = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline_by_key.get(key(result))
+        if old is None:
+            continue
+        if result[field] > old[field] * (1 + tolerance):
+            regressions.append(f"{key(result)}: {old[field]:.2f}s -> {result[field]:.2f}s")
+    return regressions
+
+
+def load_baseline(path: str, mode: str) -> list[dict]:
+    """The results of an earlier run of the same mode ("train_bpe" or "pretokenizers")."""
+    with open(path) as f:
+        baseline = json.load(f)
+    baseline_mode = baseline.get("mode", "train_bpe")
+    if baseline_mode != mode:
+        raise SystemExit(f"{path} holds {baseline_mode} results, it can't be a baseline for {mode}")
+    return baseline["results"]
+
+
+def check_regressions(results: list[dict], baseline_path: str | None, mode: str, tolerance: float, **kwargs) -> int:
+    """Print the regressions against baseline_path, if given. Returns the exit status."""
+    if baseline_path is None:
+        return 0
+    regressions = find_regressions(results, load_baseline(baseline_path, mode), tolerance, **kwargs)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def compare_pretokenizers(sizes: list[int], work_dir: str, fixtures_dir: str, seed: int, repeats: int) -> list[dict]:
+    """Best-of-repeats time of PAT and of the ASCII fast path over the documents of every corpus size."""
+    documents = load_documents(fixtures_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for size in sizes:
+        with open(corpus_path(work_dir, size, seed, documents), encoding="utf-8") as f:
+            corpus = f.read().split("<|endoftext|>")
+        timings = {}
+        for name, find in [("regex", PAT.findall), ("ascii_fast_path", pretokenize)]:
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                pretokens = [find(document) for document in corpus]
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            timings[name] = (best, pretokens)
+        if timings["regex"][1] != timings["ascii_fast_path"][1]:
+            raise AssertionError(f"the ASCII fast path changed the pretokens of the {size} byte corpus")
+        result = {
+            "corpus_bytes": size,
+            "ascii_documents": sum(document.isascii() for document in corpus) / len(corpus),
+            "regex_seconds": timings["regex"][0],
+            "ascii_fast_path_seconds": timings["ascii_fast_path"][0],
+        }
+        result["speedup"] = result["regex_seconds"] / result["ascii_fast_path_seconds"]
+        print(f"size={size}: regex {result['regex_seconds']:.2f}s, ascii fast path "
+              f"{result['ascii_fast_path_seconds']:.2f}s ({result['speedup']:.2f}x)", file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1M", "4M", "16M"], help="corpus sizes, e.g. 1M 64M 1G")
+    parser.add_argument("--vocab-sizes", nargs="+", type=int, default=[1000, 5000])
+    parser.add_argument("--workers", nargs="+", type=int, default=[4])
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default="data/bpe_benchmark", help="where generated corpora are kept")
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(__file__), "..", "tests", "fixtures"))
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    parser.add_argument("--compare-pretokenizers", action="store_true", help="only time PAT against the ASCII fast path")
+    args = parser.parse_args(argv)
+
+    if args.compare_pretokenizers:
+        results = compare_pretokenizers([parse_size(size) for size in args.sizes], args.work_dir, args.fixtures, args.seed, args.repeats)
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"mode": "pretokenizers", "results": results}, f, indent=2)
+        return check_regressions(results, args.baseline, "pretokenizers", args.tolerance, key=pretokenizer_key, field="ascii_fast_path_seconds")
+
+    results = run([parse_size(size) for size in args.sizes], args.vocab_sizes, args.workers, args.work_dir, args.fixtures, args.seed, args.repeats)
+    output = {"mode": "train_bpe", "results": results, "merge_loop_scaling": merge_loop_scaling(results)}
+    print(json.dumps(output["merge_loop_scaling"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    return check_regressions(results, args.baseline, "train_bpe", args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import os
+import pickle
+import threading
+from array import array
+
+from cs336_basics.word_table import WordTable
+
+CHECKPOINT_VERSION = 3
+
+
+def save_state(path: str, state: dict) -> None:
+    """Pickle state to path. Written to a temporary file first, so a crash mid-write keeps the previous checkpoint."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_state(path: str, special_tokens: list[str], input_key: str | None = None, pruning_settings: dict | None = None) -> tuple[WordTable, list[tuple[bytes, bytes]], dict[int, bytes], dict | None]:
+    """
+    Load a checkpoint written by BackgroundCheckpointer: (table, merges, vocab, pruning report or None). The pair
+    counts are not stored, count_pairs recomputes them from the table. With input_key set (see
+    pretokenize_cache_key), a checkpoint of a different corpus is rejected, and one whose table was pruned with other
+    settings than pruning_settings (min_frequency and max_pretokens) as well.
+    """
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    if state["version"] != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} has checkpoint version {state['version']}, expected {CHECKPOINT_VERSION}")
+    if state["special_tokens"] != special_tokens:
+        raise ValueError(f"{path} was trained with special tokens {state['special_tokens']}, not {special_tokens}")
+    if input_key is not None and state["input_key"] != input_key:
+        raise ValueError(f"{path} was trained on a different input")
+    if pruning_settings is not None and state["pruning_settings"] != pruning_settings:
+        raise ValueError(f"{path} was trained with pruning {state['pruning_settings']}, not {pruning_settings}")
+    table = WordTable(state["tokens"], state["offsets"], state["lengths"], state["freqs"])
+    return table, state["merges"], state["vocab"], state["pruning"]
+
+
+class BackgroundCheckpointer:
+    """
+    Saves the BPE training state every `every` merges. The state is copied in the merge loop (a few memcpys for the
+    word table, the pair counts are left out and recomputed on load), and pickling and writing happen on a
+    background thread. At most one write is in flight: if the previous one hasn't finished when the next checkpoint
+    is due, the merge loop waits for it. input_key identifies the corpus and pruning_settings the pruning of the
+    table, both are checked by load_state. pruning is the pruning report, saved as it stands at every checkpoint.
+    """
+
+    def __init__(self, path: str, every: int, special_tokens: list[str], input_key: str | None = None, pruning_settings: dict | None = None, pruning: dict | None = None):
+        self.path = path
+        self.every = every
+        self.special_tokens = special_tokens
+        self.input_key = input_key
+        self.pruning_settings = pruning_settings
+        self.pruning = pruning
+        self.thread = None
+
+    def maybe_save(self, table: WordTable, merges: list[tuple[bytes, bytes]], vocab: dict[int, bytes]) -> None:
+        if len(merges) % self.every == 0:
+            self.save(table, merges, vocab)
+
+    def save(self, table: WordTable, merges: list[tuple[bytes, bytes]], vocab: dict[int, bytes]) -> None:
+        self.wait()
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "special_tokens": list(self.special_tokens),
+            "input_key": self.input_key,
+            "pruning_settings": self.pruning_settings,
+            "pruning": None if self.pruning is None else dict(self.pruning),
+            "tokens": array("i", table.tokens),
+            "offsets": array("q", table.offsets),
+            "lengths": array("i", table.lengths),
+            "freqs": array("q", table.freqs),
+            "merges": list(merges),
+            "vocab": dict(vocab),
+        }
+        self.thread = threading.Thread(target=save_state, args=(self.path, state))
+        self.thread.start()
+
+    def wait(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
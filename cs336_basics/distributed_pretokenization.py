@@ -0,0 +1,119 @@
+"""
+Pretokenization spread over several machines with submitit.
+
+The work units of the corpus are dealt out to num_jobs submitit jobs (a job array). Every job counts its units with
+a local Pool and writes the counts as a shard to shard_dir, which has to be on storage all nodes can reach. A single
+reducer job then merges the shards into one table. Any submitit executor works: an AutoExecutor runs on SLURM when
+it is available, and a LocalExecutor runs the same jobs as local processes, for trying it out on one machine.
+
+    executor = submitit.AutoExecutor(folder="logs/pretokenize")
+    executor.update_parameters(timeout_min=60, cpus_per_task=32, slurm_partition="cpu")
+    counts = distributed_pretokenize_file("data/owt_train.txt", ["<|endoftext|>"], "/shared/shards", executor, num_jobs=16)
+"""
+import os
+import uuid
+from collections import Counter
+from multiprocessing import Pool
+
+from cs336_basics.instrumentation import Instrumentation, NoInstrumentation
+from cs336_basics.pretokenization import (GZIP_BLOCK_SIZE, imap_bounded, load_counts,
+                                          save_counts, split_chunk_args,
+                                          split_gzip_units, work_units)
+from cs336_basics.special_tokens import SpecialTokenMatcher
+
+
+def pretokenize_shard(args: list[tuple], num_processes: int, shard_path: str, block_size: int = GZIP_BLOCK_SIZE) -> str:
+    """
+    Job body: count the pretokens of the given split_chunk argument tuples and save them to shard_path. A .gz unit is
+    decompressed by the job and spread over its pool in blocks of block_size bytes, like in pretokenize_file.
+    """
+    counts = Counter()
+    with Pool(num_processes) as p:
+        for partial in imap_bounded(p, split_chunk_args, split_gzip_units(args, block_size), 2 * num_processes):
+            counts.update(partial)
+        # submitit jobs ignore SIGTERM, and so do the workers they fork, so the terminate() on leaving the with
+        # block would hang. Let them exit on their own instead.
+        p.close()
+        p.join()
+    save_counts(shard_path, counts)
+    return shard_path
+
+def reduce_shards(shard_paths: list[str], out_path: str) -> str:
+    """Reducer job body: sum the shards into out_path. The shards are deleted once they are merged."""
+    counts = Counter()
+    for path in shard_paths:
+        counts.update(load_counts(path))
+    save_counts(out_path, counts)
+    for path in shard_paths:
+        os.remove(path)
+    return out_path
+
+def distributed_pretokenize_file(filepath, special_tokens: list[str], shard_dir: str, executor=None, num_jobs: int = 4, num_processes: int = 4, chunk_size: int | None = None, window_size: int | None = None, instrumentation: Instrumentation | None = None) -> Counter:
+    """
+    pretokenize_file with the work spread over num_jobs submitit jobs of num_processes workers each. Returns the same
+    counts.
+
+    executor defaults to a submitit.AutoExecutor logging to shard_dir/logs; pass a configured one to choose the
+    cluster resources. chunk_size is the size of the work units (by default one per worker over all jobs) and of
+    the blocks a job cuts a .gz file into (GZIP_BLOCK_SIZE by default). A job that fails raises here when its result
+    is collected.
+
+    instrumentation, if given, records the boundary_search, pretokenize and reduce phases.
+    """
+    import submitit
+
+    timer = instrumentation or NoInstrumentation()
+    os.makedirs(shard_dir, exist_ok=True)
+    if executor is None:
+        executor = submitit.AutoExecutor(folder=os.path.join(shard_dir, "logs"))
+    SPECIAL = SpecialTokenMatcher(special_tokens)
+    max_special_len = max(map(len, special_tokens), default=0)
+
+    with timer.phase("boundary_search"):
+        units = work_units(filepath, num_jobs * num_processes, chunk_size)
+    args = [(path, SPECIAL, start, end, window_size, max_special_len) for path, start, end in units]
+    num_jobs = max(1, min(num_jobs, len(args)))
+    # runs writing to the same shard_dir must not pick up each other's shards
+    run_id = uuid.uuid4().hex
+    shard_paths = [os.path.join(shard_dir, f"shard-{run_id}-{i}.bin") for i in range(num_jobs)]
+
+    with timer.phase("pretokenize"):
+        # dealt round robin, so that the big .gz units at the front don't all land in the same job
+        jobs = executor.map_array(pretokenize_shard, [args[i::num_jobs] for i in range(num_jobs)], [num_processes] * num_jobs,
+                                  shard_paths, [chunk_size or GZIP_BLOCK_SIZE] * num_jobs)
+        shard_paths = [job.result() for job in jobs]
+    with timer.phase("reduce"):
+        out_path = os.path.join(shard_dir, f"pretokens-{run_id}.bin")
+        executor.submit(reduce_shards, shard_paths, out_path).result()
+        counts = load_counts(out_path)
+        os.remove(out_path)
+    return counts
+
+
+class SubmititBackend:
+    """
+    Pretokenization backend of train_bpe that runs distributed_pretokenize_file: num_jobs submitit jobs (executor,
+    or SLURM if available) write their counts to shard_dir on shared storage for a reducer job to merge.
+    num_processes is then the number of workers per job.
+    """
+
+    def __init__(self, shard_dir: str, executor=None, num_jobs: int = 4):
+        self.shard_dir = shard_dir
+        self.executor = executor
+        self.num_jobs = num_jobs
+
+    def pretokenize(
+        self,
+        input_path,
+        special_tokens: list[str],
+        num_processes: int,
+        chunk_size: int | None = None,
+        window_size: int | None = None,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """(pretoken bytes, count) pairs of input_path."""
+        counts = distributed_pretokenize_file(input_path, special_tokens, self.shard_dir, executor=self.executor,
+                                              num_jobs=self.num_jobs, num_processes=num_processes,
+                                              chunk_size=chunk_size, window_size=window_size,
+                                              instrumentation=instrumentation)
+        return counts.items()
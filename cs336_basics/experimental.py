@@ -1,10 +1,11 @@
-import cProfile
-import pstats
+import argparse
 
 import regex as re  # supports negative look-ahead
 
+from cs336_basics.instrumentation import Instrumentation, NoInstrumentation
 
-def pre_tokenize(file_path):
+
+def pre_tokenize(file_path, verbose=False):
     PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
     with open(file_path) as f:
         text = f.read()
@@ -12,10 +13,11 @@ def pre_tokenize(file_path):
     counts = dict()
     for word in split_text:
         counts[tuple(word)] = counts.get(tuple(word), 0) + 1
-    print(counts)
+    if verbose:
+        print(counts)
     return counts
 
-def find_merge_candidates(counts):
+def find_merge_candidates(counts, verbose=False):
     # look through all dict antries, find pairs and add to new dict.
     merge_candidates = {}
     for k, v in counts.items():
@@ -24,22 +26,24 @@ def find_merge_candidates(counts):
 
     # sort by number of occurences first, then "largest" characters in pair
     merge_candidates = sorted(merge_candidates.items(), key=lambda x: (x[1], x[0]), reverse=True)
-    print(merge_candidates)
+    if verbose:
+        print(merge_candidates)
     return merge_candidates
 
-def merge_pairs(candidates, num_merges, counts):
+def merge_pairs(candidates, num_merges, counts, verbose=False):
     # merge num_merges most common pairs
     merges = []
     for _ in range(num_merges):
         new_merge = candidates[0][0]
         merges.append(new_merge)
-        counts = update_counts(counts, new_merge)
-        candidates = find_merge_candidates(counts) # first thing to improve. need to combine this and previous step.
-        print(new_merge)
+        counts = update_counts(counts, new_merge, verbose)
+        candidates = find_merge_candidates(counts, verbose) # first thing to improve. need to combine this and previous step.
+        if verbose:
+            print(new_merge)
 
     return merges
 
-def update_counts(counts, new_merge):
+def update_counts(counts, new_merge, verbose=False):
     new_token = "".join(new_merge)
     new_counts = {}
     for k, v in counts.items():
@@ -53,7 +57,8 @@ def update_counts(counts, new_merge):
                 skip = False
                 continue
             if new_merge == (c1, c2):
-                print(f"{c1, c2} should be merged")
+                if verbose:
+                    print(f"{c1, c2} should be merged")
                 new_k.append(new_token)
                 skip = True
                 update = True
@@ -64,23 +69,29 @@ def update_counts(counts, new_merge):
             if update and not skip:
                 new_k.append(c2)
         if update:
-            print(f"going from {k} to {tuple(new_k)}")
+            if verbose:
+                print(f"going from {k} to {tuple(new_k)}")
             k = tuple(new_k)
         new_counts[k] = new_counts.get(k, 0) + v
 
     return new_counts
 
 if __name__ == '__main__':
-    with cProfile.Profile() as profile:
-        num_merges = 15
-        file = "data/minimal.txt"
-        counts = pre_tokenize(file_path=file)
-        candidates = find_merge_candidates(counts)
-        merges = merge_pairs(candidates, num_merges=num_merges, counts=counts)
-        print(merges)
-        result = pstats.Stats(profile)
-        result.sort_stats(pstats.SortKey.TIME)
-        result.print_stats(10)
-
-
+    parser = argparse.ArgumentParser(description="Toy BPE on a small file.")
+    parser.add_argument("--file", default="data/minimal.txt")
+    parser.add_argument("--num-merges", type=int, default=15)
+    parser.add_argument("--verbose", action="store_true", help="print the intermediate counts and every merge")
+    parser.add_argument("--instrument", action="store_true", help="print per-phase wall time and peak RSS")
+    args = parser.parse_args()
 
+    timer = Instrumentation() if args.instrument else NoInstrumentation()
+    with timer.phase("pretokenize"):
+        counts = pre_tokenize(file_path=args.file, verbose=args.verbose)
+    with timer.phase("initial_pair_count"):
+        candidates = find_merge_candidates(counts, args.verbose)
+    with timer.phase("merge_loop"):
+        merges = merge_pairs(candidates, num_merges=args.num_merges, counts=counts, verbose=args.verbose)
+    timer.record("num_merges", len(merges))
+    print(merges)
+    if args.instrument:
+        print(timer.to_json())
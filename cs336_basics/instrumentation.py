@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import psutil
+
+
+def total_rss(process: psutil.Process) -> int:
+    """RSS of process and all its children (the pretokenization pool) in bytes."""
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:  # exited between listing and reading
+            pass
+    return rss
+
+
+class Instrumentation:
+    """
+    Opt-in measurements for a train_bpe run: wall time and peak RSS (including worker processes) per phase,
+    throughput, and any extra values recorded along the way. Pass an instance to train_bpe and call report()
+    or to_json() afterwards.
+
+    Peak RSS is sampled by a background thread every sample_interval seconds while a phase is running, so very
+    short spikes can be missed.
+    """
+
+    def __init__(self, sample_interval: float = 0.05):
+        self.sample_interval = sample_interval
+        self.process = psutil.Process()
+        self.phases = {}
+        self.values = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        peak = total_rss(self.process)
+        stop = threading.Event()
+
+        def sample():
+            nonlocal peak
+            while not stop.wait(self.sample_interval):
+                peak = max(peak, total_rss(self.process))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stop.set()
+            sampler.join()
+            peak = max(peak, total_rss(self.process))
+            self.phases[name] = {"seconds": seconds, "peak_rss_mb": peak / 2**20}
+
+    def record(self, name: str, value) -> None:
+        self.values[name] = value
+
+    def report(self) -> dict:
+        report = {"phases": self.phases, **self.values}
+        input_bytes = self.values.get("input_bytes")
+        pretokenize = self.phases.get("pretokenize")
+        if input_bytes is not None and pretokenize and pretokenize["seconds"] > 0:
+            report["pretokenize_mb_per_second"] = input_bytes / 2**20 / pretokenize["seconds"]
+        num_merges = self.values.get("num_merges")
+        merge_loop = self.phases.get("merge_loop")
+        if num_merges is not None and merge_loop and merge_loop["seconds"] > 0:
+            report["merges_per_second"] = num_merges / merge_loop["seconds"]
+        report["total_seconds"] = sum(phase["seconds"] for phase in self.phases.values())
+        return report
+
+    def to_json(self, path: str | None = None) -> str:
+        text = json.dumps(self.report(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+
+class NoInstrumentation:
+    """Stand-in used when instrumentation is off: phases are bare nullcontexts and nothing is recorded."""
+
+    def phase(self, name: str):
+        return nullcontext()
+
+    def record(self, name: str, value) -> None:
+        pass
@@ -0,0 +1,94 @@
+import heapq
+import zlib
+from collections import Counter
+from collections.abc import Iterable
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+
+from cs336_basics.instrumentation import NoInstrumentation
+from cs336_basics.train_bpe import (MergeCandidate, count_pairs, pop_best_pair,
+                                    push_changed, update_counts)
+from cs336_basics.word_table import WordTable
+
+
+def merge_worker(conn: Connection, items: list[tuple[bytes, int]]) -> None:
+    """
+    Own one shard of the words. Sends the shard's pair counts once, then for every (pair, token_id) received applies
+    the merge to the shard and sends back the pair count deltas it caused. Stops on None.
+    """
+    table = WordTable.from_items(items)
+    del items
+    pair_counts, pair_index = count_pairs(table)
+    conn.send(pair_counts)
+    del pair_counts
+    while (message := conn.recv()) is not None:
+        pair, token_id = message
+        deltas = Counter()
+        update_counts(table, pair_index, pair, token_id=token_id, pair_counts=deltas, changed=set())
+        for changed_pair in deltas:
+            if not pair_index.get(changed_pair, True):  # no word in this shard has it anymore
+                del pair_index[changed_pair]
+        conn.send({changed_pair: delta for changed_pair, delta in deltas.items() if delta})
+    conn.close()
+
+
+def parallel_merge_pairs(items: Iterable[tuple[bytes, int]], num_merges: int, vocab: dict[int, bytes], num_workers: int, timer=None) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    merge_pairs with the words sharded by hash across num_workers processes.
+
+    The coordinator keeps the global pair counts and the heap, so it picks the best pair exactly like merge_pairs
+    does, then broadcasts it. Every worker rewrites its own words and reports its deltas, which are summed into the
+    global counts before the next round. The per-round cost in the coordinator is proportional to the number of
+    pairs that changed, the rewriting is spread over the workers.
+    """
+    timer = timer or NoInstrumentation()
+    with timer.phase("initial_pair_count"):
+        # crc32 rather than hash(): it must not depend on the interpreter's hash seed
+        shards = [[] for _ in range(num_workers)]
+        for word, count in items:
+            shards[zlib.crc32(word) % num_workers].append((word, count))
+        conns = []
+        processes = []
+        for shard in shards:
+            parent_conn, child_conn = Pipe()
+            process = Process(target=merge_worker, args=(child_conn, shard), daemon=True)
+            process.start()
+            child_conn.close()
+            conns.append(parent_conn)
+            processes.append(process)
+        del shards
+
+        pair_counts = Counter()
+        for conn in conns:
+            pair_counts.update(conn.recv())
+
+    merges = []
+    token_id = len(vocab)
+    try:
+        with timer.phase("merge_loop"):
+            heap = [MergeCandidate(v, pair, vocab) for pair, v in pair_counts.items() if v > 0]
+            heapq.heapify(heap)
+            while len(merges) < num_merges:
+                best_pair = pop_best_pair(heap, pair_counts)
+                if best_pair is None:  # every pretoken is a single token, nothing left to merge
+                    break
+                token_a, token_b = best_pair
+                vocab[token_id] = vocab[token_a] + vocab[token_b]
+                merges.append((vocab[token_a], vocab[token_b]))
+
+                for conn in conns:
+                    conn.send((best_pair, token_id))
+                changed = set()
+                for conn in conns:
+                    for pair, delta in conn.recv().items():
+                        pair_counts[pair] += delta
+                        changed.add(pair)
+                push_changed(heap, pair_counts, changed, vocab)
+                token_id += 1
+    finally:
+        for conn in conns:
+            conn.send(None)
+            conn.close()
+        for process in processes:
+            process.join()
+    return vocab, merges
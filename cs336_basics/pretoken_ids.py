@@ -0,0 +1,73 @@
+"""
+Save the segmentation the BPE merge loop already computed, so a corpus can be encoded without running BPE on it.
+
+At the end of training every distinct pretoken in the word table is already split into its final tokens, so
+train_bpe(..., pretoken_ids_path=...) saves that pretoken -> token ids map (save_pretoken_ids).
+tokenizer.encode_file(..., pretoken_ids_path=...) then looks every pretoken of the corpus up in the map first. Pretokens
+that are missing from it (pruned ones, or a different corpus) go through the Tokenizer as usual.
+
+    encode_file("data/owt_train.txt", "owt_train.npy", vocab, merges, ["<|endoftext|>"], pretoken_ids_path="owt.ids")
+"""
+import mmap
+import os
+import struct
+from array import array
+from itertools import accumulate
+
+from cs336_basics.word_table import WordTable
+
+PRETOKEN_IDS_MAGIC = b"CS336PRETOKIDS2"
+
+
+def save_pretoken_ids(path: str, table: WordTable, vocab: dict[int, bytes]) -> None:
+    """
+    Write the segmentation of every word in table: the id typecode ("H", or "I" when the vocab doesn't fit in
+    uint16), number of entries, then the key lengths and id counts (uint32), all keys concatenated (a key is the bytes
+    of the pretoken, the join of its tokens) and all ids.
+    """
+    typecode = "H" if max(vocab) < 1 << 16 else "I"
+    key_lengths = array("I")
+    id_counts = array("I", table.lengths)
+    keys = []
+    ids = array(typecode)
+    for word_id in range(len(table)):
+        word = table.word(word_id)
+        key = b"".join(vocab[token] for token in word)
+        keys.append(key)
+        key_lengths.append(len(key))
+        ids.extend(array(typecode, word))
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(PRETOKEN_IDS_MAGIC)
+        f.write(typecode.encode("ascii"))
+        f.write(struct.pack("<Q", len(keys)))
+        f.write(key_lengths.tobytes())
+        f.write(id_counts.tobytes())
+        f.write(b"".join(keys))
+        f.write(ids.tobytes())
+    os.replace(tmp_path, path)
+
+def load_pretoken_ids(path: str) -> dict[str, tuple[int, ...]]:
+    """Inverse of save_pretoken_ids, keyed by the pretoken text like Tokenizer.encode_pretoken."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(PRETOKEN_IDS_MAGIC)] != PRETOKEN_IDS_MAGIC:
+            raise ValueError(f"{path} is not a pretoken ids file")
+        typecode = chr(mm[len(PRETOKEN_IDS_MAGIC)])
+        view = memoryview(mm)[len(PRETOKEN_IDS_MAGIC) + 1:]
+        (n,) = struct.unpack_from("<Q", view)
+        key_lengths = array("I")
+        key_lengths.frombytes(view[8:8 + 4 * n])
+        id_counts = array("I")
+        id_counts.frombytes(view[8 + 4 * n:8 + 8 * n])
+        keys_start = 8 + 8 * n
+        ids_start = keys_start + sum(key_lengths)
+        pretoken_ids = {}
+        key_ends = accumulate(key_lengths, initial=keys_start)
+        itemsize = array(typecode).itemsize
+        id_ends = accumulate((itemsize * count for count in id_counts), initial=ids_start)
+        key_start, id_start = next(key_ends), next(id_ends)
+        for key_end, id_end in zip(key_ends, id_ends):
+            pretoken_ids[str(view[key_start:key_end], "utf-8")] = tuple(view[id_start:id_end].cast(typecode))
+            key_start, id_start = key_end, id_end
+        del view
+    return pretoken_ids
@@ -1,10 +1,28 @@
+import codecs
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
 import os
+import queue
+import re as std_re
+import shutil
+import struct
+import tempfile
+import zlib
+from array import array
 from collections import Counter
-from multiprocessing import Lock, Pool
+from itertools import accumulate, islice
+from multiprocessing import Pool
+from operator import itemgetter
 from typing import BinaryIO
 
 import regex as re
 
+from cs336_basics.instrumentation import Instrumentation, NoInstrumentation
+from cs336_basics.special_tokens import SpecialTokenMatcher
+
 
 def find_chunk_boundaries(
     file: BinaryIO, 
@@ -14,6 +32,7 @@ def find_chunk_boundaries(
     """
     Chunk the file into parts that can be counted independently.
     May return fewer chunks if the boundaries end up overlapping.
+    The file is memory mapped and searched with find, so no data is copied into Python.
     """
     assert isinstance(split_special_token, bytes), (
         "Must represent special token as a bytestring"
@@ -23,6 +42,8 @@ def find_chunk_boundaries(
     file.seek(0, os.SEEK_END)
     file_size = file.tell()
     file.seek(0)
+    if file_size == 0:
+        return [0]
 
     chunk_size = file_size // desired_num_chunks
 
@@ -30,78 +51,604 @@ def find_chunk_boundaries(
     # Chunks start on previous index, don't include last index
     chunk_boundaries = [i * chunk_size for i in range(desired_num_chunks + 1)]
     chunk_boundaries[-1] = file_size
-    
-    chunk_bu_boundaries = chunk_boundaries[:]
-    backup_split_token = ".\n".encode("utf-8")
 
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for bi in range(1, len(chunk_boundaries) - 1):
+            initial_position = chunk_boundaries[bi]  # Start at boundary guess
 
-    mini_chunk_size = 4096  # Read ahead by 4k bytes at a time
+            # Find the special token after the guess. If there is none, this boundary should be at the end of the file
+            found_at = mm.find(split_special_token, initial_position)
+            chunk_boundaries[bi] = file_size if found_at == -1 else found_at
 
-    for bi in range(1, len(chunk_boundaries) - 1):
-        no_backup = True
-        initial_position = chunk_boundaries[bi]
-        file.seek(initial_position)  # Start at boundary guess
-        while True:
-            mini_chunk = file.read(mini_chunk_size)  # Read a mini chunk
+    # Make sure all boundaries are unique, but might be fewer than desired_num_chunks
+    return sorted(set(chunk_boundaries))
 
-            # If EOF, this boundary should be at the end of the file
-            if mini_chunk == b"":
-                chunk_boundaries[bi] = file_size
-                break
+def iter_documents(mm, SPECIAL, start, end):
+    """Yield (start, end) of the text between special tokens in mm[start:end]. Only positions, nothing is copied."""
+    for match_start, match_end in SPECIAL.finditer(mm, start, end):
+        yield start, match_start
+        start = match_end
+    yield start, end
 
-            # Find the special token in the mini chunk
-            
-            found_at = mini_chunk.find(split_special_token)
-            if found_at != -1:
-                chunk_boundaries[bi] = initial_position + found_at
-                break
+PAT = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
-            # Find a backup breakpoint
-            if no_backup:
-                found_bu = mini_chunk.find(backup_split_token)
-                if found_bu != -1:
-                    chunk_bu_boundaries[bi] = initial_position + found_bu
-                    no_backup = False
+def ascii_class(pattern: str) -> str:
+    """The ASCII characters matched by pattern under the regex module, escaped for a character class."""
+    return std_re.escape("".join(chr(c) for c in range(128) if re.fullmatch(pattern, chr(c))))
 
-            initial_position += mini_chunk_size
+# PAT restricted to ASCII text, for the stdlib re module, which is quite a bit faster on plain character classes than
+# regex on Unicode properties. The classes are taken from regex itself, so both agree on what counts as whitespace.
+ASCII_SPACE, ASCII_LETTER, ASCII_NUMBER = ascii_class(r"\s"), ascii_class(r"\p{L}"), ascii_class(r"\p{N}")
+ASCII_PAT = std_re.compile(
+    rf"""'(?:[sdmt]|ll|ve|re)| ?[{ASCII_LETTER}]+| ?[{ASCII_NUMBER}]+| ?[^{ASCII_SPACE}{ASCII_LETTER}{ASCII_NUMBER}]+"""
+    rf"""|[{ASCII_SPACE}]+(?![^{ASCII_SPACE}])|[{ASCII_SPACE}]+""")
 
-    # Make sure all boundaries are unique, but might be fewer than desired_num_chunks
-    print(f"{sorted(set(chunk_boundaries))=}, {sorted(set(chunk_bu_boundaries))}")
-    return sorted(set(chunk_boundaries))
+def pattern_for(text: str):
+    """ASCII_PAT if text is pure ASCII (most documents of English corpora), PAT otherwise. Both give the same pretokens."""
+    return ASCII_PAT if text.isascii() else PAT
+
+NON_ASCII = re.compile(r"[^\x00-\x7f]+")
+# No pretoken has whitespace after a non-whitespace character, and PAT never looks behind. So text can be cut
+# between a non-whitespace and a whitespace character without changing the pretokens on either side.
+SAFE_SPLIT = re.compile(r"(?<=\S)(?=\s)")
+SAFE_SPLIT_REVERSE = re.compile(r"(?r)(?<=\S)(?=\s)")
+NON_ASCII_GAP = 64  # non-ASCII runs at most this far apart are matched by one PAT call
+
+def pretokenize(text: str, pos: int = 0, endpos: int | None = None) -> list[str]:
+    """
+    PAT.findall(text, pos, endpos), with everything but the stretches around non-ASCII characters matched by
+    ASCII_PAT. Every non-ASCII run is widened to the nearest safe split on either side (see SAFE_SPLIT) and only
+    that goes through PAT, so a single accented word or emoji no longer sends a whole document to the slow regex.
+    """
+    endpos = len(text) if endpos is None else endpos
+    if pos == 0 and endpos == len(text) and text.isascii():
+        return ASCII_PAT.findall(text)
+    pretokens = []
+    ascii_start = pos
+    while (match := NON_ASCII.search(text, ascii_start, endpos)) is not None:
+        split = SAFE_SPLIT_REVERSE.search(text, ascii_start, match.start() + 1)
+        start = ascii_start if split is None else split.start()
+        while match is not None:
+            split = SAFE_SPLIT.search(text, match.end(), endpos)
+            end = endpos if split is None else split.start()
+            match = NON_ASCII.search(text, end, min(end + NON_ASCII_GAP, endpos))
+        pretokens += ASCII_PAT.findall(text, ascii_start, start)
+        pretokens += PAT.findall(text, start, end)
+        ascii_start = end
+    pretokens += ASCII_PAT.findall(text, ascii_start, endpos)
+    return pretokens
+
+# Characters past the end of a pretoken that can still change how it is matched: a contraction looks at most
+# two characters ahead, and \s+(?!\S) one.
+PAT_LOOKAHEAD = 3
+
+def split_buffer(buffer, special, max_special_len, final, keep_special=False):
+    """
+    Pretokenize as much of buffer as is certain not to change when more text is appended. Yields the pretokens
+    (and the special tokens if keep_special) and returns the unfinished remainder to carry into the next window.
 
-def split_chunk(filepath, SPECIAL, start, end):
-    print(f"This is process {os.getpid()}")
+    A special token is only taken once it can no longer be the prefix of a longer one, and pretokens only up to the
+    last safe split (see SAFE_SPLIT) far enough from the end of the buffer that a special token that is still
+    incomplete can't reach it. Without one, pretokens are taken one by one while they end before the regex lookahead
+    could reach them. If final, everything is consumed.
+    """
+    pos = 0
+    for match_start, match_end in special.finditer(buffer):
+        if not final and match_start + max_special_len > len(buffer):
+            break
+        yield from pretokenize(buffer, pos, match_start)
+        if keep_special:
+            yield buffer[match_start:match_end]
+        pos = match_end
+    if final:
+        yield from pretokenize(buffer, pos)
+        return ""
+    safe_end = len(buffer) - max_special_len - PAT_LOOKAHEAD
+    if safe_end > pos and (split := SAFE_SPLIT_REVERSE.search(buffer, pos, safe_end + 1)) is not None:
+        yield from pretokenize(buffer, pos, split.start())
+        return buffer[split.start():]
+    # no whitespace to cut at, take the pretokens one by one
+    for match in pattern_for(buffer).finditer(buffer, pos):
+        if match.end() > safe_end:
+            break
+        yield match.group()
+        pos = match.end()
+    return buffer[pos:]
+
+def iter_pretokens(pieces, SPECIAL, max_special_len, keep_special=False):
+    """
+    Pretokenize text arriving in pieces of any size, e.g. fixed-size windows of a file. Unfinished text is carried
+    across piece edges, so the result is the same as splitting the concatenated text on the special tokens and
+    running PAT over every document. Memory is bounded by the piece size plus the longest pretoken.
+    """
+    carry = ""
+    for piece in pieces:
+        carry = yield from split_buffer(carry + piece, SPECIAL, max_special_len, final=False, keep_special=keep_special)
+    yield from split_buffer(carry, SPECIAL, max_special_len, final=True, keep_special=keep_special)
+
+STREAM_WINDOW_SIZE = 1 << 20  # default window for streamed input: .gz files, and mapped ones when keep_special is set
+
+def iter_windows(mm, start, end, window_size):
+    """Decode mm[start:end] window by window. Multi-byte characters cut by a window edge are completed in the next one."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    for window_start in range(start, end, window_size):
+        yield decoder.decode(mm[window_start:min(window_start + window_size, end)])
+    yield decoder.decode(b"", final=True)
+
+def chunk_pretokens(mm, SPECIAL, start, end, window_size=None, max_special_len=0, keep_special=False):
+    """
+    Yield the pretokens in bytes [start, end) of the mapped file mm.
+
+    With window_size set, the chunk is streamed in windows of that many bytes (see iter_pretokens), which caps
+    memory even for a single huge document. Otherwise it is processed one document at a time. keep_special also
+    yields the special tokens in between, in order (always streamed).
+    """
+    if window_size is not None or keep_special:
+        windows = iter_windows(mm, start, end, window_size or STREAM_WINDOW_SIZE)
+        yield from iter_pretokens(windows, SPECIAL, max_special_len, keep_special)
+        return
+    for doc_start, doc_end in iter_documents(mm, SPECIAL, start, end):
+        document = mm[doc_start:doc_end].decode("utf-8", errors="ignore")
+        yield from pretokenize(document) # Could potential fail if large and no <|endoftex|>. Use re.finditer() if problematic.
+
+def iter_stream_windows(f, window_size):
+    """Decode a binary stream window by window, like iter_windows does for a mapped range."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    while window := f.read(window_size):
+        yield decoder.decode(window)
+    yield decoder.decode(b"", final=True)
+
+def file_pretokens(filepath, SPECIAL, start, end, window_size=None, max_special_len=0, keep_special=False):
+    """
+    Yield the pretokens of one work unit: bytes [start, end) of a plain file, bytes [start, end) of a decompressed
+    block (filepath is then the bytes of the block, see split_gzip_units), or a whole .gz file (start and end are
+    ignored), decompressed and streamed through iter_pretokens. The pools only hand out .gz files as blocks.
+    """
+    if isinstance(filepath, bytes):
+        yield from chunk_pretokens(filepath, SPECIAL, start, end, window_size, max_special_len, keep_special)
+        return
+    if filepath.endswith(".gz"):
+        with gzip.open(filepath, "rb") as f:
+            windows = iter_stream_windows(f, window_size or STREAM_WINDOW_SIZE)
+            yield from iter_pretokens(windows, SPECIAL, max_special_len, keep_special)
+        return
+    # The file is mapped, not read: the page cache is shared between workers, and only one document (or window)
+    # at a time is copied out and decoded.
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield from chunk_pretokens(mm, SPECIAL, start, end, window_size, max_special_len, keep_special)
+
+def split_chunk(filepath, SPECIAL, start, end, window_size=None, max_special_len=0):
+    """Count the pretokens of one work unit, see file_pretokens."""
     counts = Counter()
-    PAT = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
-    with open(filepath, "rb") as f:
-        f.seek(start)
-        chunk = f.read(end - start).decode("utf-8", errors="ignore")
-        #lock = Lock()
-        split_special = re.split(SPECIAL, chunk)
-        for document in split_special:
-            for word in PAT.findall(document): # Could potential fail if large and no <|endoftex|>. Use re.finditer() if problematic.
-                counts[tuple(word.encode())] += 1
-                
+    counts.update(map(str.encode, file_pretokens(filepath, SPECIAL, start, end, window_size, max_special_len)))
     return counts
 
-def pretokenize_file(filepath: str, num_processes: int, special_tokens: list[str]) -> dict[str, int]:
+def split_chunk_args(args):
+    """split_chunk taking a single argument tuple, for Pool.imap_unordered."""
+    return split_chunk(*args)
+
+def pack_counts(counts: dict[bytes, int]) -> bytes:
+    """
+    Serialize a pretoken table compactly: number of entries, then the key lengths (uint32), the counts (int64)
+    and finally all keys concatenated. Much smaller and faster to send between processes than a pickled Counter.
+    """
+    keys = list(counts)
+    lengths = array("I", map(len, keys))
+    values = array("q", counts.values())
+    return struct.pack("<Q", len(keys)) + lengths.tobytes() + values.tobytes() + b"".join(keys)
+
+def unpack_counts(blob) -> Counter:
+    """Inverse of pack_counts. Accepts anything supporting the buffer protocol (bytes, mmap, memoryview)."""
+    view = memoryview(blob)
+    (n,) = struct.unpack_from("<Q", view)
+    lengths = array("I")
+    lengths.frombytes(view[8:8 + 4 * n])
+    values = array("q")
+    values.frombytes(view[8 + 4 * n:8 + 12 * n])
+    keys_start = 8 + 12 * n
+    ends = accumulate(lengths, initial=keys_start)
+    start = next(ends)
+    counts = Counter()
+    for end, value in zip(ends, values):
+        counts[bytes(view[start:end])] = value
+        start = end
+    return counts
+
+def split_chunk_packed(args) -> bytes:
+    return pack_counts(split_chunk(*args))
+
+def merge_packed(a: bytes, b: bytes) -> bytes:
+    """Reduce step: merge two packed tables into one packed table."""
+    counts = unpack_counts(a)
+    for k, v in unpack_counts(b).items():
+        counts[k] += v
+    return pack_counts(counts)
+
+def tree_reduce(p: Pool, blobs: list[bytes]) -> bytes:
+    """Merge packed tables pairwise in the pool, halving their number each round, until one is left."""
+    while len(blobs) > 1:
+        merged = p.starmap(merge_packed, zip(blobs[0::2], blobs[1::2]), chunksize=1)
+        if len(blobs) % 2:
+            merged.append(blobs[-1])
+        blobs = merged
+    return blobs[0]
+
+CACHE_MAGIC = b"CS336PRETOK1"
+
+def pretokenize_cache_key(filepath, special_tokens: list[str]) -> str:
+    """
+    Identify a pretokenization result: the input files (size, mtime and a hash of their contents), the PAT regex and
+    the special tokens. Hashing a file is a single sequential read, far cheaper than pretokenizing it again.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([PAT.pattern, special_tokens]).encode("utf-8"))
+    for path in expand_inputs(filepath):
+        stat = os.stat(path)
+        h.update(json.dumps([stat.st_size, stat.st_mtime_ns]).encode("utf-8"))
+        if stat.st_size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
+
+def save_counts(path: str, counts: dict[bytes, int]) -> None:
+    """Write a pretoken table in the pack_counts format. Written to a temporary file first, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(pack_counts(counts))
+    os.replace(tmp_path, path)
+
+def load_counts(path: str) -> Counter:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+            raise ValueError(f"{path} is not a pretokenization cache file")
+        return unpack_counts(memoryview(mm)[len(CACHE_MAGIC):])
+
+def cached_pretokenize_file(filepath, cache_dir: str, special_tokens: list[str], instrumentation: Instrumentation | None = None, **kwargs) -> dict[bytes, int]:
+    """pretokenize_file, but reuse the result stored in cache_dir if this file was already pretokenized with the same settings."""
+    timer = instrumentation or NoInstrumentation()
+    os.makedirs(cache_dir, exist_ok=True)
+    with timer.phase("cache_lookup"):
+        cache_path = os.path.join(cache_dir, f"pretokens-{pretokenize_cache_key(filepath, special_tokens)}.bin")
+        cache_hit = os.path.exists(cache_path)
+        timer.record("pretokenize_cache_hit", cache_hit)
+        if cache_hit:
+            return load_counts(cache_path)
+    counts = pretokenize_file(filepath, special_tokens=special_tokens, instrumentation=instrumentation, **kwargs)
+    save_counts(cache_path, counts)
+    return counts
+
+def expand_inputs(input_path) -> list[str]:
+    """A path, a directory (all files below it, in sorted order) or a list of those, as a flat list of files."""
+    paths = [input_path] if isinstance(input_path, (str, os.PathLike)) else list(input_path)
+    files = []
+    for path in map(os.fspath, paths):
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if not name.startswith("."))
+        else:
+            files.append(path)
+    return files
+
+def work_units(input_path, num_processes: int, chunk_size: int | None = None) -> list[tuple[str, int, int | None]]:
+    """
+    Cut the inputs into (file, start, end) work units. Plain files are split on <|endoftext|> into chunks of about
+    chunk_size bytes (by default, enough to give every process one chunk's worth of the total). A .gz file can't be
+    split without decompressing it, so it is a single unit here; those go first, since they are the longest to
+    process. split_gzip_units cuts them into blocks while they are being handed out.
+    """
+    files = expand_inputs(input_path)
+    plain_files = [path for path in files if not path.endswith(".gz") and os.path.getsize(path) > 0]
+    if chunk_size is None:
+        chunk_size = max(1, -(-sum(map(os.path.getsize, plain_files)) // num_processes))
+    units = [(path, 0, None) for path in files if path.endswith(".gz")]
+    for path in plain_files:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            num_chunks = max(1, -(-f.tell() // chunk_size))
+            boundaries = find_chunk_boundaries(
+                f, num_chunks, "<|endoftext|>".encode("utf-8"))
+        units.extend((path, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]))
+    return units
+
+# Decompressed bytes per block of a .gz file when no chunk_size is given
+GZIP_BLOCK_SIZE = 1 << 24
+
+def gzip_blocks(filepath: str, block_size: int, split_special_token: bytes = b"<|endoftext|>"):
+    """
+    Decompress filepath and yield it in blocks of at least block_size bytes that end right before an occurrence of
+    split_special_token (or at the end of the file), so that like the chunks of find_chunk_boundaries they can be
+    pretokenized independently. A block only ends at a split token, so its size is bounded by block_size plus the
+    longest stretch without one.
+    """
+    buffer = bytearray()
+    searched = 0  # no split token starts in buffer[block_size:searched]
+    with gzip.open(filepath, "rb") as f:
+        while data := f.read(STREAM_WINDOW_SIZE):
+            buffer += data
+            while len(buffer) > block_size:
+                found_at = buffer.find(split_special_token, max(block_size, searched))
+                if found_at == -1:
+                    searched = max(block_size, len(buffer) - len(split_special_token) + 1)
+                    break
+                yield bytes(buffer[:found_at])
+                del buffer[:found_at]
+                searched = 0
+    if buffer:
+        yield bytes(buffer)
+
+def split_gzip_units(args, block_size: int):
+    """
+    Lazily replace every split_chunk argument tuple whose unit is a whole .gz file (see work_units) by one tuple per
+    block of its decompressed stream (see gzip_blocks). Other tuples pass through unchanged.
+
+    This is a deliberate trade-off: a gzip stream can only be decompressed from its start, so the process feeding
+    the pool (the parent, or a distributed job) decompresses it serially and pickles the blocks to the workers.
+    Decompression runs several times faster than pretokenization, so a .gz file is pretokenized by all workers
+    instead of by the one that would otherwise decompress it, at the cost of copying every block once.
+    """
+    for unit in args:
+        path, SPECIAL, start, end, *rest = unit
+        if not path.endswith(".gz"):
+            yield unit
+            continue
+        for block in gzip_blocks(path, block_size):
+            yield (block, SPECIAL, 0, len(block), *rest)
+
+def imap_bounded(p: Pool, func, iterable, max_pending: int):
+    """
+    Pool.imap_unordered, except that the next item is only taken from iterable while fewer than max_pending are in
+    flight. imap_unordered consumes its input as fast as it can, which would hold every decompressed block in memory.
+    """
+    done = queue.SimpleQueue()
+    pending = 0
+
+    def result():
+        nonlocal pending
+        pending -= 1
+        ok, value = done.get()
+        if not ok:
+            raise value
+        return value
+
+    for item in iterable:
+        p.apply_async(func, (item,), callback=lambda value: done.put((True, value)), error_callback=lambda error: done.put((False, error)))
+        pending += 1
+        if pending >= max_pending:
+            yield result()
+    while pending:
+        yield result()
+
+def pretokenize_file(filepath, num_processes: int, special_tokens: list[str], chunk_size: int | None = None, parallel_reduce: bool = False, window_size: int | None = None, instrumentation: Instrumentation | None = None) -> dict[bytes, int]:
+    """
+    Count pretokens in filepath using num_processes workers. filepath may also be a directory, a .gz file or a list
+    of those (see work_units).
+
+    By default the input is cut into one chunk per process. With chunk_size set, it is instead cut into many
+    special-token-aligned work units of roughly chunk_size bytes that are handed out to idle workers as they
+    finish, so one slow chunk no longer holds up the whole pool. Results are combined as they arrive.
+
+    With parallel_reduce, workers send back their counts packed (see pack_counts) and the partial tables are
+    merged pairwise inside the pool, so the parent only unpacks the single merged table at the end.
+
+    With window_size set, every worker streams its chunk in windows of that many bytes instead of decoding whole
+    documents, so per-worker memory stays bounded however large a chunk or document is.
+
+    instrumentation, if given, records the boundary_search, pretokenize and reduce phases.
+    """
+    timer = instrumentation or NoInstrumentation()
     # Preprocessing special tokens 
-    escaped = [re.escape(token) for token in special_tokens]
-    SPECIAL = r"|".join(escaped)
+    SPECIAL = SpecialTokenMatcher(special_tokens)
     
-    with open(filepath, "rb") as f:
-        boundaries = find_chunk_boundaries(
-            f, num_processes, "<|endoftext|>".encode("utf-8"))
-        
+    with timer.phase("boundary_search"):
+        units = work_units(filepath, num_processes, chunk_size)
 
     # Multiprocessing
-    p = Pool(num_processes)
-    args = [(filepath, SPECIAL, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
-    collected = p.starmap(split_chunk, args)
+    max_special_len = max(map(len, special_tokens), default=0)
+    args = [(path, SPECIAL, start, end, window_size, max_special_len) for path, start, end in units]
+    args = split_gzip_units(args, chunk_size or GZIP_BLOCK_SIZE)
+    max_pending = 2 * num_processes
+    with Pool(num_processes) as p:
+        if parallel_reduce:
+            with timer.phase("pretokenize"):
+                blobs = list(imap_bounded(p, split_chunk_packed, args, max_pending))
+            with timer.phase("reduce"):
+                return unpack_counts(tree_reduce(p, blobs))
+
+        if chunk_size is not None:
+            # partial counts are combined as they arrive, so the reduction is part of this phase
+            with timer.phase("pretokenize"):
+                counts = Counter()
+                for partial in imap_bounded(p, split_chunk_args, args, max_pending):
+                    counts.update(partial)
+            return counts
+
+        with timer.phase("pretokenize"):
+            collected = list(imap_bounded(p, split_chunk_args, args, max_pending))
     
     # Hopefully temporary code to merge dictionaries from each process
-    counts = collected[0]
-    for d in collected[1:]:
-        for k, v in d.items():
-            counts[k] = counts.get(k, 0) + v
-    return counts
\ No newline at end of file
+    with timer.phase("reduce"):
+        counts = collected[0]
+        for d in collected[1:]:
+            for k, v in d.items():
+                counts[k] = counts.get(k, 0) + v
+    return counts
+
+# Rough size of one Counter entry (key object, count object and dict slot) used to turn a memory budget into a number
+# of entries. Keys are short, so the per-object overhead dominates.
+ESTIMATED_ENTRY_BYTES = 200
+SPILL_CHECK_EVERY = 1 << 16  # pretokens counted between two checks of the budget
+RUN_RECORD = struct.Struct("<IQ")  # key length, count; followed by the key
+
+def write_run(path: str, items) -> None:
+    with open(path, "wb", buffering=1 << 20) as f:
+        for key, count in items:
+            f.write(RUN_RECORD.pack(len(key), count))
+            f.write(key)
+
+def read_run(path: str):
+    """Yield the (key, count) records of a run file in order."""
+    with open(path, "rb", buffering=1 << 20) as f:
+        while header := f.read(RUN_RECORD.size):
+            length, count = RUN_RECORD.unpack(header)
+            yield f.read(length), count
+
+def spill_runs(counts: dict[bytes, int], run_dir: str, num_partitions: int) -> list[tuple[int, str]]:
+    """Write counts as one key-sorted run file per partition (crc32 of the key). Returns (partition, path) pairs."""
+    partitions = [[] for _ in range(num_partitions)]
+    for key in counts:
+        partitions[zlib.crc32(key) % num_partitions].append(key)
+    runs = []
+    for partition, keys in enumerate(partitions):
+        if not keys:
+            continue
+        keys.sort()
+        fd, path = tempfile.mkstemp(dir=run_dir, prefix=f"p{partition}-", suffix=".run")
+        os.close(fd)
+        write_run(path, ((key, counts[key]) for key in keys))
+        runs.append((partition, path))
+    return runs
+
+def split_chunk_spilling(args) -> list[tuple[int, str]]:
+    """
+    split_chunk for external aggregation: whenever the Counter grows past max_entries it is written out as sorted,
+    partitioned runs and started afresh. Everything ends up on disk; returns the (partition, path) of every run.
+    """
+    filepath, SPECIAL, start, end, window_size, max_special_len, run_dir, num_partitions, max_entries = args
+    runs = []
+    counts = Counter()
+    pretokens = map(str.encode, file_pretokens(filepath, SPECIAL, start, end, window_size, max_special_len))
+    while batch := list(islice(pretokens, SPILL_CHECK_EVERY)):
+        counts.update(batch)
+        if len(counts) > max_entries:
+            runs.extend(spill_runs(counts, run_dir, num_partitions))
+            counts = Counter()
+    if counts:
+        runs.extend(spill_runs(counts, run_dir, num_partitions))
+    return runs
+
+def merge_runs(paths: list[str], out_path: str) -> str:
+    """k-way merge of sorted runs into one sorted run, summing the counts of equal keys. The inputs are deleted."""
+    merged = heapq.merge(*(read_run(path) for path in paths), key=itemgetter(0))
+
+    def summed():
+        current, total = None, 0
+        for key, count in merged:
+            if key != current:
+                if current is not None:
+                    yield current, total
+                current, total = key, 0
+            total += count
+        if current is not None:
+            yield current, total
+
+    write_run(out_path, summed())
+    for path in paths:
+        os.remove(path)
+    return out_path
+
+def external_pretokenize_file(filepath, num_processes: int, special_tokens: list[str], spill_dir: str, memory_budget: int = 1 << 30, chunk_size: int | None = None, window_size: int | None = None, instrumentation: Instrumentation | None = None):
+    """
+    pretokenize_file for corpora whose distinct pretokens don't fit in memory.
+
+    Each worker counts until its Counter passes memory_budget bytes (estimated), then writes it to spill_dir as
+    sorted runs, one per key partition. Afterwards the runs of each partition are k-way merged in the pool. Both
+    happen before this returns; what is returned is a stream of the global table read back from disk as (pretoken
+    bytes, count) pairs, partition by partition. The run files are deleted once it is exhausted or closed. Peak
+    memory is about num_processes * memory_budget; the caller decides how compactly to hold the result (see
+    WordTable.from_items).
+    """
+    timer = instrumentation or NoInstrumentation()
+    SPECIAL = SpecialTokenMatcher(special_tokens)
+    with timer.phase("boundary_search"):
+        units = work_units(filepath, num_processes, chunk_size)
+
+    os.makedirs(spill_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix="pretokenize-", dir=spill_dir)
+    num_partitions = 4 * num_processes
+    max_entries = max(1, memory_budget // ESTIMATED_ENTRY_BYTES)
+    max_special_len = max(map(len, special_tokens), default=0)
+    args = [(path, SPECIAL, start, end, window_size, max_special_len, run_dir, num_partitions, max_entries)
+            for path, start, end in units]
+    args = split_gzip_units(args, chunk_size or GZIP_BLOCK_SIZE)
+    try:
+        with Pool(num_processes) as p:
+            with timer.phase("pretokenize"):
+                by_partition = {}
+                for runs in imap_bounded(p, split_chunk_spilling, args, 2 * num_processes):
+                    for partition, path in runs:
+                        by_partition.setdefault(partition, []).append(path)
+            with timer.phase("reduce"):
+                merged = p.starmap(merge_runs, [(paths, os.path.join(run_dir, f"merged-{partition}.run"))
+                                                for partition, paths in sorted(by_partition.items())], chunksize=1)
+    except BaseException:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        raise
+
+    def stream():
+        try:
+            yield
+            for path in merged:
+                yield from read_run(path)
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    items = stream()
+    next(items)  # started, so that closing it before reading anything still removes run_dir
+    return items
+
+
+class PoolBackend:
+    """
+    Default pretokenization backend of train_bpe: pretokenize_file on this machine, counts held in memory. With
+    cache_dir set, the result is stored there and reused by later runs on the same input (see
+    cached_pretokenize_file); pretokens don't depend on vocab_size, so sweeps over it only pretokenize once.
+    parallel_reduce is passed on to pretokenize_file.
+    """
+
+    def __init__(self, cache_dir: str | None = None, parallel_reduce: bool = False):
+        self.cache_dir = cache_dir
+        self.parallel_reduce = parallel_reduce
+
+    def pretokenize(
+        self,
+        input_path,
+        special_tokens: list[str],
+        num_processes: int,
+        chunk_size: int | None = None,
+        window_size: int | None = None,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """(pretoken bytes, count) pairs of input_path."""
+        kwargs = dict(num_processes=num_processes, special_tokens=special_tokens, chunk_size=chunk_size,
+                      parallel_reduce=self.parallel_reduce, window_size=window_size, instrumentation=instrumentation)
+        if self.cache_dir is not None:
+            return cached_pretokenize_file(input_path, self.cache_dir, **kwargs).items()
+        return pretokenize_file(input_path, **kwargs).items()
+
+
+class SpillBackend:
+    """
+    Pretokenization backend for corpora whose distinct pretokens don't fit in memory: counts are spilled to sorted
+    runs in spill_dir whenever a worker's table passes memory_budget bytes, and the merged table is streamed back
+    (see external_pretokenize_file), so the full table never exists in memory.
+    """
+
+    def __init__(self, spill_dir: str, memory_budget: int = 1 << 30):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+
+    def pretokenize(
+        self,
+        input_path,
+        special_tokens: list[str],
+        num_processes: int,
+        chunk_size: int | None = None,
+        window_size: int | None = None,
+        instrumentation: Instrumentation | None = None,
+    ):
+        """(pretoken bytes, count) pairs of input_path, streamed from disk."""
+        return external_pretokenize_file(input_path, num_processes, special_tokens, self.spill_dir,
+                                         memory_budget=self.memory_budget, chunk_size=chunk_size,
+                                         window_size=window_size, instrumentation=instrumentation)
@@ -0,0 +1,56 @@
+import regex as re
+
+
+class SpecialTokenMatcher:
+    """
+    Finds special tokens in text with leftmost-longest semantics: of the tokens starting at the leftmost position
+    the longest one wins, so "<|endoftext|><|endoftext|>" is a single match if it is a special token itself.
+
+    This is not a dedicated automaton: the tokens are compiled once into a regex alternation sorted longest-first,
+    so at any position the first alternative that matches is the longest token there. A trie walked from Python was
+    2.5 to 4 times slower than the alternation on TinyStories, with 1 or 42 special tokens, on str and bytes alike.
+    What this class adds is the one place that sets the ordering for the tokenizer and the pretokenizer. Works on
+    str, and on bytes-like objects (bytes, mmap) with the tokens UTF-8 encoded.
+    """
+
+    def __init__(self, special_tokens: list[str]):
+        self.special_tokens = list(special_tokens)
+        self.max_len = max(map(len, self.special_tokens), default=0)
+        self.max_byte_len = max((len(token.encode("utf-8")) for token in self.special_tokens), default=0)
+        tokens = sorted(set(self.special_tokens), key=len, reverse=True)
+        byte_tokens = sorted({token.encode("utf-8") for token in self.special_tokens}, key=len, reverse=True)
+        self.pattern = re.compile("|".join(map(re.escape, tokens))) if tokens else None
+        self.byte_pattern = re.compile(b"|".join(map(re.escape, byte_tokens))) if byte_tokens else None
+
+    def __bool__(self) -> bool:
+        return bool(self.special_tokens)
+
+    def finditer(self, text, pos: int = 0, endpos: int | None = None):
+        """Yield (start, end) of every special token in text[pos:endpos], left to right, non-overlapping."""
+        if not self.special_tokens:
+            return
+        pattern = self.pattern if isinstance(text, str) else self.byte_pattern
+        for match in pattern.finditer(text, pos, len(text) if endpos is None else endpos):
+            yield match.span()
+
+    def straddles(self, text, pos: int) -> bool:
+        """Whether a special token occurs in text across pos: starting before it and ending after it."""
+        if not self.special_tokens:
+            return False
+        pattern, max_len = (self.pattern, self.max_len) if isinstance(text, str) else (self.byte_pattern, self.max_byte_len)
+        for start in range(max(0, pos - max_len + 1), pos):
+            match = pattern.match(text, start)
+            if match is not None and match.end() > pos:
+                return True
+        return False
+
+    def split(self, text: str) -> list[str]:
+        """Like re.split with a capturing group: the text between tokens at even positions, the tokens at odd ones."""
+        parts = []
+        pos = 0
+        for start, end in self.finditer(text):
+            parts.append(text[pos:start])
+            parts.append(text[start:end])
+            pos = end
+        parts.append(text[pos:])
+        return parts
@@ -0,0 +1,311 @@
+import codecs
+import gzip
+import json
+import mmap
+import os
+from array import array
+from collections.abc import Iterable, Iterator
+from functools import lru_cache, partial
+from itertools import accumulate, chain
+from multiprocessing import Pool
+
+import numpy as np
+
+from cs336_basics.pretoken_ids import load_pretoken_ids
+from cs336_basics.pretokenization import (STREAM_WINDOW_SIZE, expand_inputs,
+                                          iter_pretokens, iter_stream_windows,
+                                          iter_windows, pretokenize)
+from cs336_basics.special_tokens import SpecialTokenMatcher
+
+
+def bytes_to_unicode() -> dict[int, str]:
+    """The GPT-2 mapping of every byte to a printable character, used by the vocab and merges files."""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars = printable[:]
+    shift = 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            chars.append(256 + shift)
+            shift += 1
+    return dict(zip(printable, map(chr, chars)))
+
+
+def merge_pretoken(pretoken: str, byte_ids: list[int], ranks: dict[tuple[int, int], tuple[int, int]]) -> tuple[int, ...]:
+    """BPE on one pretoken: merge every occurrence of the adjacent pair with the lowest rank until none is left."""
+    ids = [byte_ids[b] for b in pretoken.encode("utf-8")]
+    while len(ids) > 1:
+        candidates = [(ranks[pair], pair) for pair in zip(ids, ids[1:]) if pair in ranks]
+        if not candidates:
+            break
+        (_, merged_id), (first, second) = min(candidates)
+        merged = []
+        i = 0
+        n = len(ids)
+        while i < n:
+            if i + 1 < n and ids[i] == first and ids[i + 1] == second:
+                merged.append(merged_id)
+                i += 2
+            else:
+                merged.append(ids[i])
+                i += 1
+        ids = merged
+    return tuple(ids)
+
+
+class Tokenizer:
+    """
+    Byte-level BPE tokenizer for a trained (vocab, merges).
+
+    A pretoken starts out as the ids of its bytes, then the adjacent pair with the lowest merge rank is merged
+    (every occurrence of it) until no pair left has a rank. The merges list itself is never scanned: the ranks
+    live in a dict keyed by pair of ids. Pretokens repeat a lot in natural text, so their ids are kept in a
+    per-tokenizer LRU cache of cache_size entries; cache_stats() reports how well it does.
+
+    Special tokens are never split and always take priority over the merges, the longest one first when they
+    overlap. Those missing from vocab are appended to (a copy of) it.
+    """
+
+    def __init__(self, vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], special_tokens: list[str] | None = None, cache_size: int = 1 << 16):
+        vocab = dict(vocab)
+        self.merges = merges
+        self.special_tokens = sorted(special_tokens or [], key=len, reverse=True)
+        # several ids can share the same bytes (e.g. a special token added twice), the lowest one wins
+        self.token_ids = {}
+        for token_id, token in sorted(vocab.items()):
+            self.token_ids.setdefault(token, token_id)
+        for token in special_tokens or []:
+            if token.encode("utf-8") not in self.token_ids:
+                token_id = max(vocab, default=-1) + 1
+                vocab[token_id] = token.encode("utf-8")
+                self.token_ids[token.encode("utf-8")] = token_id
+        self.vocab = vocab
+        self.byte_ids = [self.token_ids[bytes([b])] for b in range(256)]
+        # (id, id) -> (rank, id of the merged token). A pair listed twice keeps its first (lowest) rank.
+        self.ranks = {}
+        for rank, (a, b) in enumerate(merges):
+            self.ranks.setdefault((self.token_ids[a], self.token_ids[b]), (rank, self.token_ids[a + b]))
+        self.special_ids = {token: self.token_ids[token.encode("utf-8")] for token in self.special_tokens}
+        self.special = SpecialTokenMatcher(self.special_tokens)
+        self.max_special_len = max(map(len, self.special_tokens), default=0)
+        # cached around a partial rather than the bound method: the cache would keep the tokenizer alive in a cycle
+        self.encode_pretoken = lru_cache(maxsize=cache_size)(partial(merge_pretoken, byte_ids=self.byte_ids, ranks=self.ranks))
+        # all token bytes in one flat buffer, token i is token_bytes[token_offsets[i]:token_offsets[i + 1]]
+        # (ids missing from vocab are empty)
+        lengths = np.zeros(max(vocab, default=-1) + 1, dtype=np.int64)
+        lengths[list(vocab)] = [len(token) for token in vocab.values()]
+        self.token_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        flat = bytearray(int(self.token_offsets[-1]))
+        for token_id, token in vocab.items():
+            flat[self.token_offsets[token_id]:self.token_offsets[token_id + 1]] = token
+        self.token_bytes = np.frombuffer(bytes(flat), dtype=np.uint8)
+
+    @classmethod
+    def from_files(cls, vocab_filepath: str, merges_filepath: str, special_tokens: list[str] | None = None, **kwargs) -> "Tokenizer":
+        """Load a GPT-2 style vocab (JSON of token -> id) and merges file (one "token token" line per merge)."""
+        byte_decoder = {char: b for b, char in bytes_to_unicode().items()}
+        with open(vocab_filepath, encoding="utf-8") as f:
+            vocab = {token_id: bytes(byte_decoder[char] for char in token) for token, token_id in json.load(f).items()}
+        merges = []
+        with open(merges_filepath, encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip().split(" ")
+                if len(parts) == 2 and not line.startswith("#version"):
+                    merges.append(tuple(bytes(byte_decoder[char] for char in part) for part in parts))
+        return cls(vocab, merges, special_tokens, **kwargs)
+
+    def to_files(self, vocab_filepath: str, merges_filepath: str) -> None:
+        """Write vocab and merges in the format from_files reads."""
+        byte_encoder = bytes_to_unicode()
+        with open(vocab_filepath, "w", encoding="utf-8") as f:
+            json.dump({"".join(byte_encoder[b] for b in token): token_id for token_id, token in self.vocab.items()}, f, ensure_ascii=False)
+        with open(merges_filepath, "w", encoding="utf-8") as f:
+            for a, b in self.merges:
+                f.write(f"{''.join(byte_encoder[x] for x in a)} {''.join(byte_encoder[x] for x in b)}\n")
+
+    def merge_pretoken(self, pretoken: str) -> tuple[int, ...]:
+        """The ids of one pretoken, uncached (see encode_pretoken)."""
+        return merge_pretoken(pretoken, self.byte_ids, self.ranks)
+
+    def cache_stats(self) -> dict:
+        info = self.encode_pretoken.cache_info()
+        lookups = info.hits + info.misses
+        return {"hits": info.hits, "misses": info.misses, "hit_rate": info.hits / lookups if lookups else 0.0, "size": info.currsize}
+
+    def encode(self, text: str) -> list[int]:
+        ids = []
+        # the special tokens are at the odd positions
+        parts = self.special.split(text)
+        for i, part in enumerate(parts):
+            if i % 2:
+                ids.append(self.special_ids[part])
+            elif part:
+                ids.extend(chain.from_iterable(map(self.encode_pretoken, pretokenize(part))))
+        return ids
+
+    def encode_batches(self, iterable: Iterable[str], batch_size: int = 1 << 13) -> Iterator[array]:
+        """
+        Encode text arriving in pieces (e.g. the lines of a file) into arrays of about batch_size ids, uint16 when
+        the vocab fits. Only the text after the last pretoken boundary that is certain not to move is held back
+        between pieces (see iter_pretokens), including a special token that is cut by a piece edge, so memory doesn't
+        grow with the input.
+        """
+        typecode = "H" if max(self.vocab) < 1 << 16 else "I"
+        encode_pretoken = self.encode_pretoken
+        special_ids = self.special_ids
+        batch = array(typecode)
+        for pretoken in iter_pretokens(iterable, self.special, self.max_special_len, keep_special=True):
+            # a PAT pretoken can't be equal to a special token, the text is split on those first
+            if pretoken in special_ids:
+                batch.append(special_ids[pretoken])
+            else:
+                batch.extend(encode_pretoken(pretoken))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = array(typecode)
+        if batch:
+            yield batch
+
+    def encode_iterable(self, iterable: Iterable[str]) -> Iterator[int]:
+        """encode_batches one id at a time. The ids are the same as encode() of the whole text."""
+        for batch in self.encode_batches(iterable):
+            yield from batch
+
+    def decode_bytes(self, ids) -> bytes:
+        """The concatenated bytes of ids (a list or array), gathered from the flat token buffer with numpy."""
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = self.token_offsets[ids]
+        lengths = self.token_offsets[ids + 1] - starts
+        # position k of the output is byte (k - where its token starts in the output) of that token
+        output_starts = np.cumsum(lengths) - lengths
+        index = np.arange(lengths.sum()) + np.repeat(starts - output_starts, lengths)
+        return self.token_bytes[index].tobytes()
+
+    def decode(self, ids: Iterable[int]) -> str:
+        return self.decode_bytes(list(ids)).decode("utf-8", errors="replace")
+
+    def decode_iterable(self, batches: Iterable) -> Iterator[str]:
+        """
+        Decode ids arriving in batches (arrays or lists, e.g. from encode_batches, or single ids). A character whose
+        bytes are split over several tokens is held back until it is complete, so the joined output is the same as
+        decode() of all ids at once.
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for batch in batches:
+            text = decoder.decode(self.decode_bytes([batch] if isinstance(batch, int) else batch))
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+
+# Set in every worker by init_worker, so the tokenizer is built once per process. Its pretoken cache stays warm
+# from the counting pass to the writing pass.
+worker_tokenizer = None
+
+def init_worker(vocab, merges, special_tokens, pretoken_ids_path=None):
+    global worker_tokenizer
+    worker_tokenizer = Tokenizer(vocab, merges, special_tokens)
+    if pretoken_ids_path is not None:
+        # pretokens segmented during training are looked up, only the others go through the (cached) merges
+        pretoken_ids = load_pretoken_ids(pretoken_ids_path)
+        merge_cached = worker_tokenizer.encode_pretoken
+        worker_tokenizer.encode_pretoken = lambda pretoken: pretoken_ids.get(pretoken) or merge_cached(pretoken)
+
+def chunk_batches(filepath: str, start: int, end: int | None) -> Iterator[array]:
+    if filepath.endswith(".gz"):
+        with gzip.open(filepath, "rb") as f:
+            yield from worker_tokenizer.encode_batches(iter_stream_windows(f, STREAM_WINDOW_SIZE), batch_size=1 << 16)
+        return
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield from worker_tokenizer.encode_batches(iter_windows(mm, start, end, STREAM_WINDOW_SIZE), batch_size=1 << 16)
+
+def count_chunk(args) -> int:
+    filepath, start, end = args
+    return sum(map(len, chunk_batches(filepath, start, end)))
+
+def write_chunk(args) -> None:
+    filepath, start, end, output_path, dtype, offset = args
+    tokens = np.load(output_path, mmap_mode="r+") if output_path.endswith(".npy") else np.memmap(output_path, dtype=dtype, mode="r+")
+    for batch in chunk_batches(filepath, start, end):
+        tokens[offset:offset + len(batch)] = np.frombuffer(batch, dtype=dtype)
+        offset += len(batch)
+    tokens.flush()
+
+def special_token_boundaries(mm, special: SpecialTokenMatcher, num_chunks: int, split_special_token: bytes) -> list[int]:
+    """
+    Like find_chunk_boundaries, but every cut is at the start of a match the tokenizer itself would make: the first
+    match of special at or after each evenly spaced guess that starts with split_special_token and that no special
+    token occurrence straddles. Any match straddling it would start earlier, so its start would depend on how the
+    text before it is matched (e.g. inside a run of "<|endoftext|>" when "<|endoftext|><|endoftext|>" is special
+    too). Without that, leftmost-longest matching from the start of the file is sure to begin a match there.
+    """
+    size = len(mm)
+    boundaries = [0]
+    for i in range(1, num_chunks):
+        pos = max(boundaries[-1] + 1, i * size // num_chunks - special.max_byte_len)
+        for start, _ in special.finditer(mm, pos):
+            if mm[start:start + len(split_special_token)] == split_special_token and not special.straddles(mm, start):
+                boundaries.append(start)
+                break
+        else:
+            break
+    boundaries.append(size)
+    return boundaries
+
+def file_chunks(input_path, num_chunks: int, special: SpecialTokenMatcher, split_special_token: bytes | None) -> list[tuple[str, int, int | None]]:
+    """
+    Cut the inputs (a file, directory or list, see expand_inputs) into (file, start, end) chunks in corpus order.
+    The plain files share num_chunks in proportion to their size, cut before split_special_token (see
+    special_token_boundaries), or not at all when it is None. A .gz file is a single chunk, end is None.
+    """
+    files = expand_inputs(input_path)
+    total = sum(os.path.getsize(path) for path in files if not path.endswith(".gz"))
+    chunk_size = max(1, -(-total // num_chunks))
+    chunks = []
+    for path in files:
+        if path.endswith(".gz"):
+            chunks.append((path, 0, None))
+            continue
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if split_special_token is None:
+                boundaries = [0, len(mm)]
+            else:
+                boundaries = special_token_boundaries(mm, special, max(1, -(-len(mm) // chunk_size)), split_special_token)
+        chunks.extend((path, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]))
+    return chunks
+
+def encode_file(input_path, output_path: str, vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], special_tokens: list[str], num_processes: int = 4, num_chunks: int | None = None, split_special_token: str = "<|endoftext|>", pretoken_ids_path: str | None = None) -> int:
+    """
+    Encode input_path (a file, directory or list of files, .gz ones included) into one contiguous token file: a .npy
+    if output_path ends in .npy, raw ids otherwise, either way ready for np.load(mmap_mode="r") / np.memmap. The ids
+    are uint16, or uint32 when the vocab doesn't fit. Returns the number of tokens.
+
+    The plain files are cut before split_special_token (special_token_boundaries) into num_chunks chunks, 4 per
+    process by default, and encoded in two passes over the pool: first every chunk is encoded only to count its tokens, which
+    gives each chunk its offset in a preallocated memmap, then every worker encodes its chunk again straight into
+    that slice. Nothing but the counts goes through the parent.
+
+    With pretoken_ids_path (saved by train_bpe, see pretoken_ids), pretokens are looked up in that map first and
+    only the missing ones are merged.
+    """
+    # with the special tokens missing from vocab appended, as the workers' tokenizers will have them
+    vocab = Tokenizer(vocab, merges, special_tokens, cache_size=0).vocab
+    dtype = np.dtype(np.uint16 if max(vocab) < 1 << 16 else np.uint32)
+    # without it being a special token, text on both sides of a cut could pretokenize differently
+    split_token = split_special_token.encode("utf-8") if split_special_token in special_tokens else None
+    chunks = file_chunks(input_path, num_chunks or 4 * num_processes, SpecialTokenMatcher(special_tokens), split_token)
+    with Pool(num_processes, initializer=init_worker, initargs=(vocab, merges, special_tokens, pretoken_ids_path)) as p:
+        counts = p.map(count_chunk, chunks, chunksize=1)
+        num_tokens = sum(counts)
+        # preallocated (sparse) at its final size, so the workers can map it
+        with open(output_path, "wb") as out:
+            if output_path.endswith(".npy"):
+                np.lib.format.write_array_header_1_0(out, {"descr": dtype.str, "fortran_order": False, "shape": (num_tokens,)})
+            out.truncate(out.tell() + dtype.itemsize * num_tokens)
+        offsets = accumulate(counts, initial=0)
+        p.map(write_chunk, [(*chunk, output_path, dtype, offset) for chunk, offset, count in zip(chunks, offsets, counts) if count], chunksize=1)
+    return num_tokens
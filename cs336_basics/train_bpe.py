@@ -1,104 +1,398 @@
-import cProfile
-import pstats
+import argparse
+import heapq
+import os
+from array import array
 from typing import BinaryIO
-from collections import Counter
+from collections import Counter, defaultdict
+from collections.abc import Iterable
 
-from cs336_basics.pretokenization import (find_chunk_boundaries,
-                                          pretokenize_file)
+from cs336_basics.bpe_checkpoint import BackgroundCheckpointer, load_state
+from cs336_basics.instrumentation import Instrumentation, NoInstrumentation
+from cs336_basics.pretoken_ids import save_pretoken_ids
+from cs336_basics.pretokenization import (PoolBackend, expand_inputs,
+                                          find_chunk_boundaries,
+                                          pretokenize_cache_key)
+from cs336_basics.word_table import WordTable
 
 
-def train_bpe(input_path: str, vocab_size: int, special_tokens: list[str], num_processes: int = 4) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
-    num_merges = vocab_size - 256 - len(special_tokens)
+def train_bpe(
+    input_path: str | list[str],
+    vocab_size: int | list[int],
+    special_tokens: list[str],
+    num_processes: int = 4,
+    chunk_size: int | None = None,
+    window_size: int | None = None,
+    backend=None,
+    checkpoint_path: str | None = None,
+    checkpoint_every: int = 1000,
+    resume: bool = False,
+    merge_processes: int = 1,
+    min_frequency: int = 1,
+    max_pretokens: int | None = None,
+    pruning_report: dict | None = None,
+    pretoken_ids_path: str | None = None,
+    instrumentation: Instrumentation | None = None,
+) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]] | list[tuple[dict[int, bytes], list[tuple[bytes, bytes]]]]:
+    """
+    Train a byte-level BPE tokenizer on input_path: a text file, a .gz-compressed one, a directory of them or a
+    list of any of those. Compressed files are decompressed on the fly and handed to the workers in blocks.
+
+    backend decides where and how the pretokens are counted; num_processes, chunk_size and window_size are passed
+    on to it. The default, PoolBackend(), counts in memory with a local pool, and PoolBackend(cache_dir) reuses
+    the counts of earlier runs on the same input. SpillBackend(spill_dir, memory_budget) aggregates the counts
+    externally through sorted runs on disk and streams them into the word table, for corpora whose pretoken table
+    doesn't fit in memory. distributed_pretokenization.SubmititBackend(shard_dir, executor, num_jobs) spreads the
+    work over submitit jobs writing to shared storage; num_processes is then the number of workers per job.
+
+    vocab_size may also be a list of sizes. Merges are learned in order, so a smaller vocab is just a prefix of a
+    larger one: the merges are run once up to the largest size, and a (vocab, merges) pair is returned for every
+    requested size, identical to training each one separately.
+
+    With checkpoint_path set, the training state is saved there every checkpoint_every merges (in the background).
+    With resume, a run continues from that checkpoint if it exists, skipping pretokenization, and learns the same
+    merges an uninterrupted run would. The checkpoint must come from the same input (see pretokenize_cache_key) and
+    pruning settings, and the pruning report it was saved with is restored into pruning_report; if it already holds
+    more merges than vocab_size needs, the result is truncated.
+
+    With merge_processes > 1, the merge loop itself runs in parallel: the words are sharded across that many
+    processes, which apply each merge to their shard and report pair count deltas back (see parallel_merge).
+    The merges are identical to the single-process ones. Checkpointing is not supported in this mode.
+
+    min_frequency and max_pretokens prune rare pretokens before the merge loop (see prune_pretokens), trading a little
+    fidelity for memory and merge time. Pass a dict as pruning_report to get the report of prune_pretokens in it:
+    how much was dropped and exact_merges, how many of the learned merges are guaranteed to match an unpruned run
+    (not computed with merge_processes > 1). It is also recorded as "pruning" by the instrumentation. When an exact
+    run is available, merge_drift measures the actual difference.
+
+    With pretoken_ids_path set, the final segmentation of every pretoken is saved there once the merges are done.
+    tokenizer.encode_file(..., pretoken_ids_path=...) can then turn the corpus into a token file with one lookup per
+    pretoken instead of a full BPE encode. Only supported for a single vocab_size and merge_processes == 1.
+
+    Pass an Instrumentation to get per-phase wall time, peak RSS and throughput for the run. Without one, nothing
+    is measured.
+    """
+    timer = instrumentation or NoInstrumentation()
+    backend = backend or PoolBackend()
+    vocab_sizes = vocab_size if isinstance(vocab_size, list) else [vocab_size]
+    num_merges = max(vocab_sizes) - 256 - len(special_tokens)
     vocab = {i:bytes([i]) for i in range(256)}
     vocab.update({256+i:token.encode("utf-8") for i, token in enumerate(special_tokens)})
 
-    counts = pretokenize_file(filepath=input_path, num_processes=num_processes, special_tokens=special_tokens)
-    candidates = find_merge_candidates(counts, vocab)
+    if merge_processes > 1 and checkpoint_path is not None:
+        raise ValueError("checkpointing is not supported with merge_processes > 1")
+    if pretoken_ids_path is not None and (merge_processes > 1 or isinstance(vocab_size, list)):
+        raise ValueError("pretoken_ids_path needs a single vocab_size and merge_processes == 1")
 
-    return merge_pairs(candidates, num_merges=num_merges, counts=counts, vocab=vocab)
+    pruning_settings = {"min_frequency": min_frequency, "max_pretokens": max_pretokens}
+    if checkpoint_path is not None:
+        with timer.phase("input_key"):
+            input_key = pretokenize_cache_key(input_path, special_tokens)
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        with timer.phase("load_checkpoint"):
+            table, merges, vocab, pruning = load_state(checkpoint_path, special_tokens, input_key, pruning_settings)
+        if len(merges) > num_merges and pretoken_ids_path is not None:
+            raise ValueError(f"{checkpoint_path} is past the requested vocab_size, its pretoken ids can't be saved")
+        if pruning is not None:
+            if pruning_report is not None:
+                pruning_report.clear()
+                pruning_report.update(pruning)
+                pruning = pruning_report
+            timer.record("pruning", pruning)
+        with timer.phase("initial_pair_count"):
+            pair_counts, pair_index = count_pairs(table)
+    else:
+        if instrumentation is not None:
+            timer.record("input_bytes", sum(map(os.path.getsize, expand_inputs(input_path))))
+        # a dict view, or a stream from disk with SpillBackend: the full Counter need not exist in memory
+        items = backend.pretokenize(input_path, special_tokens, num_processes, chunk_size=chunk_size,
+                                    window_size=window_size, instrumentation=instrumentation)
+        pruning = None
+        if min_frequency > 1 or max_pretokens is not None:
+            with timer.phase("prune"):
+                items, pruning = prune_pretokens(items, min_frequency, max_pretokens)
+            if pruning_report is not None:
+                # merge_pairs adds exact_merges to the same dict
+                pruning_report.clear()
+                pruning_report.update(pruning)
+                pruning = pruning_report
+            timer.record("pruning", pruning)
+        if merge_processes > 1:
+            from cs336_basics.parallel_merge import parallel_merge_pairs
+            vocab, merges = parallel_merge_pairs(items, num_merges, vocab, merge_processes, timer)
+            timer.record("num_merges", len(merges))
+            if not isinstance(vocab_size, list):
+                return vocab, merges
+            return [truncate_vocab(vocab, merges, size) for size in vocab_sizes]
+        with timer.phase("build_table"):
+            # words are addressed by their position in the table from here on, so the pair index can refer to them by id
+            table = WordTable.from_items(items)
+            del items
+        with timer.phase("initial_pair_count"):
+            pair_counts, pair_index = count_pairs(table)
+        merges = []
 
-def find_merge_candidates(counts: dict, vocab: dict) -> dict[int, tuple]:
-    """look through all dict entries, find pairs and add to new dict."""
-    merge_candidates = Counter()
-    for k, v in counts.items():
-        for c1, c2 in zip(k, k[1:]):
-            pair = (c1, c2) 
-            merge_candidates[pair] += v
-            #merge_candidates[pair] = merge_candidates.get(pair, 0) + v
+    checkpointer = None
+    if checkpoint_path is not None:
+        checkpointer = BackgroundCheckpointer(checkpoint_path, checkpoint_every, special_tokens, input_key, pruning_settings, pruning)
+    merges_before = len(merges)
+    with timer.phase("merge_loop"):
+        vocab, merges = merge_pairs(pair_counts, pair_index, num_merges=num_merges, table=table, vocab=vocab, merges=merges, checkpointer=checkpointer, pruning=pruning)
+    timer.record("num_merges", len(merges) - merges_before)
+    if pretoken_ids_path is not None:
+        with timer.phase("save_pretoken_ids"):
+            save_pretoken_ids(pretoken_ids_path, table, vocab)
+    if not isinstance(vocab_size, list):
+        # a resumed checkpoint may hold more merges than asked for
+        return truncate_vocab(vocab, merges, vocab_size)
+    return [truncate_vocab(vocab, merges, size) for size in vocab_sizes]
 
-    # sort by number of occurences first, then "largest" characters in lexicographical order using vocab
-    # Not happy about using the vocab dict as a sorting key. Perhaps an indication that merge candidates "should" not be stored as ints in the first place?
-    merge_candidates = sorted(merge_candidates.items(), key=lambda x: (x[1], (vocab[x[0][0]], vocab[x[0][1]])), reverse=True)
+def extend_bpe(
+    vocab: dict[int, bytes],
+    merges: list[tuple[bytes, bytes]],
+    input_path: str | list[str],
+    vocab_size: int,
+    special_tokens: list[str],
+    num_processes: int = 4,
+    chunk_size: int | None = None,
+    window_size: int | None = None,
+    backend=None,
+    instrumentation: Instrumentation | None = None,
+) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """
+    Grow an existing tokenizer to vocab_size with merges learned on input_path (e.g. a new domain). All existing
+    token ids keep their meaning: special tokens not in vocab yet are appended, then the new merge tokens.
 
-    return merge_candidates
+    The existing merges are replayed over the new pretoken table first. Each one only rewrites the words that
+    contain its pair (through the pair index, like a regular merge), and no heap is kept while replaying, so this
+    costs about as much as applying the merges once. The merge loop then continues from that state. On the corpus
+    the tokenizer was trained on, the result is identical to training with the larger vocab_size from scratch.
+    """
+    timer = instrumentation or NoInstrumentation()
+    if set(vocab) != set(range(len(vocab))):
+        raise ValueError("vocab ids must be 0..len(vocab)-1")
+    vocab = dict(vocab)
+    merges = list(merges)
+    # the ids of the existing tokens are looked up by their bytes, whatever the layout of vocab (train_bpe puts the
+    # special tokens before the merges, GPT-2 after them). If two ids have the same bytes the lowest one wins, like
+    # in Tokenizer.
+    token_ids = {}
+    for token_id, token in sorted(vocab.items()):
+        token_ids.setdefault(token, token_id)
+    for token in special_tokens:
+        if token.encode("utf-8") not in token_ids:
+            token_ids[token.encode("utf-8")] = len(vocab)
+            vocab[len(vocab)] = token.encode("utf-8")
+    num_merges = len(merges) + vocab_size - len(vocab)
 
-def merge_pairs(candidates, num_merges, counts, vocab):
-    """merge num_merges most common pairs"""
-    merges = []
-    token_id = len(vocab)
-    for _ in range(num_merges):
-        best_pair = candidates[0][0] 
+    byte_ids = {b: token_ids[bytes([b])] for b in range(256) if bytes([b]) in token_ids}
+    if len(byte_ids) != 256:
+        raise ValueError("vocab must contain all 256 single bytes")
+    missing = [a + b for a, b in merges if a + b not in token_ids]
+    if missing:
+        raise ValueError(f"vocab has no token for merges {missing[:5]}")
 
-        token_a, token_b = best_pair
-        bytes_a, bytes_b = vocab[token_a], vocab[token_b]
+    if instrumentation is not None:
+        timer.record("input_bytes", sum(map(os.path.getsize, expand_inputs(input_path))))
+    items = (backend or PoolBackend()).pretokenize(input_path, special_tokens, num_processes, chunk_size=chunk_size,
+                                                   window_size=window_size, instrumentation=instrumentation)
+    with timer.phase("build_table"):
+        table = WordTable.from_items(items)
+        del items
+    with timer.phase("initial_pair_count"):
+        if any(byte_ids[b] != b for b in byte_ids):
+            table.tokens = array("i", map(byte_ids.__getitem__, table.tokens))
+        pair_counts, pair_index = count_pairs(table)
 
-        #print(new_merge)
-        vocab[token_id] = bytes_a + bytes_b  # need to return a byte mapping here
-        #print("u")
-        merges.append((bytes_a, bytes_b))
-        counts = update_counts(counts, best_pair, token_id=token_id)
-        #print(counts)
-        candidates = find_merge_candidates(counts, vocab) # first thing to improve. need to combine this and previous step.
-        #print(new_merge)
-        token_id += 1
+    with timer.phase("replay_merges"):
+        changed = set()
+        for bytes_a, bytes_b in merges:
+            pair = (token_ids[bytes_a], token_ids[bytes_b])
+            update_counts(table, pair_index, pair, token_id=token_ids[bytes_a + bytes_b], pair_counts=pair_counts, changed=changed)
+        for pair in changed:
+            if pair_counts.get(pair) == 0:
+                del pair_counts[pair]
+                pair_index.pop(pair, None)
 
+    merges_before = len(merges)
+    with timer.phase("merge_loop"):
+        vocab, merges = merge_pairs(pair_counts, pair_index, num_merges=num_merges, table=table, vocab=vocab, merges=merges)
+    timer.record("num_merges", len(merges) - merges_before)
     return vocab, merges
 
-def update_counts(counts, new_merge, token_id):
-    #new_token = "".join(new_merge)
-    new_counts = {}
-    for k, v in counts.items():
-        
-        new_k = []
-        skip = False
-        update = False
-        for c1, c2 in zip(k, k[1:]):
-            # print(new_merge, (c1, c2))
-            # need to merge in new token without screwing with existing...
-            if skip:
-                skip = False
-                continue
-            if new_merge == (c1, c2):
-                #print(f"{c1, c2} should be merged")
-                new_k.append(token_id)
-                skip = True
-                update = True
-            else:
-                new_k.append(c1)
-                
+def prune_pretokens(items: Iterable[tuple[bytes, int]], min_frequency: int = 1, max_pretokens: int | None = None) -> tuple[list[tuple[bytes, int]], dict]:
+    """
+    Drop pretokens occurring fewer than min_frequency times, then keep only the max_pretokens most frequent ones
+    (ties broken by the bytes, so the result is deterministic). Returns the kept items and a report of what was
+    dropped; dropped_pair_mass bounds how much any pair count can be off during the merges.
+    """
+    kept = []
+    total_distinct = total_occurrences = dropped_occurrences = dropped_pair_mass = 0
+    for word, count in items:
+        total_distinct += 1
+        total_occurrences += count
+        if count >= min_frequency:
+            kept.append((word, count))
         else:
-            if update and not skip:
-                new_k.append(c2)
-        if update:
-            #print(f"going from {k} to {tuple(new_k)}")
-            k = tuple(new_k)
-            
-        new_counts[k] = new_counts.get(k, 0) + v
+            dropped_occurrences += count
+            dropped_pair_mass += count * max(0, len(word) - 1)
+    if max_pretokens is not None and len(kept) > max_pretokens:
+        kept.sort(key=lambda item: (item[1], item[0]), reverse=True)
+        for word, count in kept[max_pretokens:]:
+            dropped_occurrences += count
+            dropped_pair_mass += count * max(0, len(word) - 1)
+        del kept[max_pretokens:]
+    report = {
+        "distinct_pretokens": total_distinct,
+        "kept_pretokens": len(kept),
+        "dropped_occurrence_fraction": dropped_occurrences / total_occurrences if total_occurrences else 0.0,
+        "dropped_pair_mass": dropped_pair_mass,
+    }
+    return kept, report
 
-    return new_counts
+def merge_drift(merges: list[tuple[bytes, bytes]], reference: list[tuple[bytes, bytes]]) -> dict:
+    """How far merges (e.g. from a pruned run) are from reference (the exact run): the index of the first merge that
+    differs and the fraction of reference merges that were learned at all."""
+    first_difference = next((i for i, (a, b) in enumerate(zip(merges, reference)) if a != b), min(len(merges), len(reference)))
+    overlap = len(set(merges) & set(reference)) / len(reference) if reference else 1.0
+    return {"first_difference": first_difference, "overlap": overlap}
 
+def truncate_vocab(vocab: dict[int, bytes], merges: list[tuple[bytes, bytes]], vocab_size: int) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """The (vocab, merges) a run stopped at vocab_size would have produced. Merge tokens get consecutive ids after the base vocab."""
+    num_base = len(vocab) - len(merges)
+    num_merges = max(0, vocab_size - num_base)
+    return {i: token for i, token in vocab.items() if i < num_base + num_merges}, merges[:num_merges]
 
+def count_pairs(table: WordTable) -> tuple[Counter, dict[tuple[int, int], set[int]]]:
+    """look through all words once, count every adjacent pair and record which word ids contain it.
+    Both are kept up to date by update_counts afterwards."""
+    pair_counts = Counter()
+    pair_index = defaultdict(set)
+    for word_id, v in enumerate(table.freqs):
+        word = table.word(word_id)
+        for pair in zip(word, word[1:]):
+            pair_counts[pair] += v
+            pair_index[pair].add(word_id)
+    return pair_counts, pair_index
 
 
+class MergeCandidate:
+    """Heap entry for a pair. heapq is a min-heap, so the ordering is inverted: the "smallest" entry
+    is the one with the highest count, ties broken by the lexicographically greatest (bytes_a, bytes_b).
+    Two different tokens can have the same bytes, so the ids are the last tie-break: the order must not depend on
+    when an entry was pushed, or a resumed run could pick a different merge."""
+    __slots__ = ("count", "key", "pair")
 
-if __name__ == "__main__":
-    
-    with cProfile.Profile() as profile:
-        vocab, merges = train_bpe(input_path="data/TinyStoriesV2-GPT4-valid.txt", vocab_size=270, special_tokens=["<|endoftext|>","<|imstart|>"], num_processes=4)#TinyStoriesV2-GPT4-valid.txt", vocab_size=270, special_tokens=[])
+    def __init__(self, count: int, pair: tuple[int, int], vocab: dict[int, bytes]):
+        self.count = count
+        self.pair = pair
+        self.key = (vocab[pair[0]], vocab[pair[1]])
+
+    def __lt__(self, other: "MergeCandidate") -> bool:
+        if self.count != other.count:
+            return self.count > other.count
+        if self.key != other.key:
+            return self.key > other.key
+        return self.pair > other.pair
+
+
+def pop_best_pair(heap: list[MergeCandidate], pair_counts: Counter) -> tuple[int, int] | None:
+    """Pop entries until one matches the current count of its pair. Stale entries (count changed since push) are dropped."""
+    while heap:
+        candidate = heapq.heappop(heap)
+        if candidate.count > 0 and pair_counts.get(candidate.pair) == candidate.count:
+            return candidate.pair
+    return None
 
-        result = pstats.Stats(profile)
-        result.sort_stats(pstats.SortKey.TIME)
-        result.print_stats(10)
+def peek_best_count(heap: list[MergeCandidate], pair_counts: Counter) -> int:
+    """Count of the best pair still on the heap without popping it (stale entries on top are dropped)."""
+    while heap and pair_counts.get(heap[0].pair) != heap[0].count:
+        heapq.heappop(heap)
+    return heap[0].count if heap else 0
 
+def push_changed(heap, pair_counts, changed, vocab, pair_index=None):
+    """only pairs touched by a merge get a fresh heap entry, the old ones go stale. Pairs that are gone are dropped."""
+    for pair in changed:
+        count = pair_counts.get(pair, 0)
+        if count > 0:
+            heapq.heappush(heap, MergeCandidate(count, pair, vocab))
+        else:
+            pair_counts.pop(pair, None)
+            if pair_index is not None:
+                pair_index.pop(pair, None)
+
+def merge_pairs(pair_counts, pair_index, num_merges, table, vocab, merges=None, checkpointer=None, pruning=None):
+    """merge the most common pairs until there are num_merges merges (merges may already hold some when resuming)
+
+    pruning is the report of prune_pretokens if the table was pruned. Every pair count can then be too low by at most
+    its dropped_pair_mass, so as long as the best pair leads the runner-up by more than that, the merge is the one the
+    unpruned table would have made. The number of merges before the first one without that margin is stored in it
+    as exact_merges, as soon as it is known, so a checkpoint of the report carries it over to a resumed run.
+    """
+    merges = [] if merges is None else merges
+    error_bound = pruning["dropped_pair_mass"] if pruning else 0
+    exact_merges = pruning.get("exact_merges") if pruning else None
+    token_id = len(vocab)
+    heap = [MergeCandidate(v, pair, vocab) for pair, v in pair_counts.items() if v > 0]
+    heapq.heapify(heap)
+    while len(merges) < num_merges:
+        best_pair = pop_best_pair(heap, pair_counts)
+        if best_pair is None:  # every pretoken is a single token, nothing left to merge
+            break
+        if error_bound and exact_merges is None and pair_counts[best_pair] - peek_best_count(heap, pair_counts) <= error_bound:
+            exact_merges = pruning["exact_merges"] = len(merges)
+
+        token_a, token_b = best_pair
+        bytes_a, bytes_b = vocab[token_a], vocab[token_b]
+
+        vocab[token_id] = bytes_a + bytes_b  # need to return a byte mapping here
+        merges.append((bytes_a, bytes_b))
+        changed = set()
+        update_counts(table, pair_index, best_pair, token_id=token_id, pair_counts=pair_counts, changed=changed)
+        push_changed(heap, pair_counts, changed, vocab, pair_index)
+        token_id += 1
+        if checkpointer is not None:
+            checkpointer.maybe_save(table, merges, vocab)
+
+    if checkpointer is not None:
+        checkpointer.wait()
+    if pruning is not None:
+        # a resumed checkpoint may hold more merges than asked for
+        pruning["exact_merges"] = min(len(merges) if exact_merges is None else exact_merges, num_merges)
+    return vocab, merges
+
+def update_counts(table, pair_index, new_merge, token_id, pair_counts, changed):
+    """Rewrite only the words that contain new_merge (looked up in pair_index) and apply their pair count deltas
+    to pair_counts. The index entries of the rewritten words are updated, and pairs whose count changed are added
+    to changed."""
+    for word_id in pair_index.pop(new_merge, ()):
+        word, new_word = table.merge(word_id, new_merge, token_id)
+        v = table.freqs[word_id]
+        old_pairs = list(zip(word, word[1:]))
+        new_pairs = list(zip(new_word, new_word[1:]))
+        for pair in old_pairs:
+            pair_counts[pair] -= v
+            changed.add(pair)
+        for pair in new_pairs:
+            pair_counts[pair] += v
+            changed.add(pair)
+        for pair in set(old_pairs).difference(new_pairs):
+            if pair != new_merge:
+                pair_index[pair].discard(word_id)
+        for pair in new_pairs:
+            pair_index[pair].add(word_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a byte-level BPE tokenizer.")
+    parser.add_argument("--input", default="data/TinyStoriesV2-GPT4-valid.txt")
+    parser.add_argument("--vocab-size", type=int, default=270)
+    parser.add_argument("--special-tokens", nargs="*", default=["<|endoftext|>", "<|imstart|>"])
+    parser.add_argument("--num-processes", type=int, default=4)
+    parser.add_argument("--instrument", action="store_true", help="print per-phase wall time, peak RSS and throughput")
+    args = parser.parse_args()
 
-    print(f"{len(vocab)=}, {vocab.items()=}, {merges[0]}")
\ No newline at end of file
+    instrumentation = Instrumentation() if args.instrument else None
+    vocab, merges = train_bpe(input_path=args.input, vocab_size=args.vocab_size, special_tokens=args.special_tokens, num_processes=args.num_processes, instrumentation=instrumentation)
+    if args.instrument:
+        print(instrumentation.to_json())
+    print(f"{len(vocab)=}, {merges[:1]=}")
@@ -0,0 +1,67 @@
+from array import array
+from collections.abc import Iterable
+
+
+class WordTable:
+    """Compact store for the pretoken table used during BPE training.
+
+    All words live in one flat int32 buffer: word i is tokens[offsets[i]:offsets[i] + lengths[i]] and occurs
+    freqs[i] times. A merge can only make a word shorter, so words are rewritten in place and the tail of their
+    slot is simply left unused.
+    """
+
+    def __init__(self, tokens: array, offsets: array, lengths: array, freqs: array):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.lengths = lengths
+        self.freqs = freqs
+
+    @classmethod
+    def from_items(cls, items: Iterable[tuple[bytes, int]]) -> "WordTable":
+        """Build the table from (pretoken bytes, count) pairs. Each byte becomes its own token id."""
+        tokens = array("i")
+        offsets = array("q")
+        lengths = array("i")
+        freqs = array("q")
+        offset = 0
+        batch = []
+        for word, count in items:
+            batch.append(word)
+            offsets.append(offset)
+            lengths.append(len(word))
+            freqs.append(count)
+            offset += len(word)
+            # items may be a stream larger than memory (external aggregation), so keys are only held per batch
+            if len(batch) == 1 << 16:
+                tokens.extend(array("i", array("B", b"".join(batch))))
+                batch.clear()
+        tokens.extend(array("i", array("B", b"".join(batch))))
+        return cls(tokens, offsets, lengths, freqs)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def word(self, word_id: int) -> array:
+        start = self.offsets[word_id]
+        return self.tokens[start:start + self.lengths[word_id]]
+
+    def merge(self, word_id: int, pair: tuple[int, int], token_id: int) -> tuple[array, array]:
+        """Replace every non-overlapping occurrence of pair (left to right) in word word_id with token_id.
+        Returns the word before and after the rewrite."""
+        word = self.word(word_id)
+        first, second = pair
+        new_word = array("i")
+        i = 0
+        n = len(word)
+        while i < n:
+            if i < n - 1 and word[i] == first and word[i + 1] == second:
+                new_word.append(token_id)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        start = self.offsets[word_id]
+        self.tokens[start:start + len(new_word)] = new_word
+        self.lengths[word_id] = len(new_word)
+        return word, new_word
+
@@ -1,7 +1,5 @@
 from __future__ import annotations
 
-import cProfile
-import pstats
 import os
 from collections.abc import Iterable
 from typing import IO, Any, BinaryIO
@@ -560,7 +558,8 @@ def get_tokenizer(
     Returns:
         A BPE tokenizer that uses the provided vocab, merges, and special tokens.
     """
-    raise NotImplementedError
+    from cs336_basics.tokenizer import Tokenizer
+    return Tokenizer(vocab, merges, special_tokens)
 
 
 def run_train_bpe(
@@ -591,14 +590,137 @@ def run_train_bpe(
                 Merges are ordered by order of creation.
     """
     from cs336_basics.train_bpe import train_bpe
-    with cProfile.Profile() as profile:
-        vocab, merges = train_bpe(input_path=input_path, vocab_size=vocab_size, special_tokens=special_tokens)
+    return train_bpe(input_path=input_path, vocab_size=vocab_size, special_tokens=special_tokens, **kwargs)
+
+
+
+
+def get_pool_backend(cache_dir: str | os.PathLike | None = None) -> Any:
+    """The default `train_bpe` pretokenization backend. With `cache_dir`, the pretoken
+    counts are stored there and reused by later runs on the same input and special tokens.
+    """
+    from cs336_basics.pretokenization import PoolBackend
+    return PoolBackend(None if cache_dir is None else str(cache_dir))
+
+
+def get_instrumentation() -> Any:
+    """A fresh `Instrumentation` to pass to `train_bpe`; its `report()` holds the
+    per-phase timings and throughput of the run afterwards.
+    """
+    from cs336_basics.instrumentation import Instrumentation
+    return Instrumentation()
+
+
+def get_spill_backend(spill_dir: str | os.PathLike, memory_budget: int) -> Any:
+    """A `train_bpe` pretokenization backend that aggregates the pretoken counts
+    through sorted runs in `spill_dir` whenever a worker holds more than
+    `memory_budget` bytes of them.
+    """
+    from cs336_basics.pretokenization import SpillBackend
+    return SpillBackend(str(spill_dir), memory_budget)
+
+
+def get_submitit_backend(shard_dir: str | os.PathLike, executor: Any, num_jobs: int) -> Any:
+    """A `train_bpe` pretokenization backend that counts the pretokens in
+    `num_jobs` jobs of the given submitit `executor`, sharing `shard_dir`.
+    """
+    from cs336_basics.distributed_pretokenization import SubmititBackend
+    return SubmititBackend(str(shard_dir), executor, num_jobs)
 
-        result = pstats.Stats(profile)
-        result.sort_stats(pstats.SortKey.TIME)
-        result.print_stats(10)
 
+def run_extend_bpe(
+    vocab: dict[int, bytes],
+    merges: list[tuple[bytes, bytes]],
+    input_path: str | os.PathLike,
+    vocab_size: int,
+    special_tokens: list[str],
+    **kwargs,
+) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """Given an existing tokenizer vocabulary and merges, learn further merges on
+    the corpus at `input_path` until the vocabulary has `vocab_size` items.
+    Existing token IDs keep their meaning.
 
+    Returns:
+        tuple[dict[int, bytes], list[tuple[bytes, bytes]]]: the extended vocab and merges.
+    """
+    from cs336_basics.train_bpe import extend_bpe
+    return extend_bpe(vocab, merges, input_path=input_path, vocab_size=vocab_size, special_tokens=special_tokens, **kwargs)
 
-    return vocab, merges
 
+def run_encode_file(
+    input_path: str | os.PathLike,
+    output_path: str | os.PathLike,
+    vocab: dict[int, bytes],
+    merges: list[tuple[bytes, bytes]],
+    special_tokens: list[str],
+    **kwargs,
+) -> int:
+    """Encode the text at `input_path` (a file, directory or list of files) with the
+    tokenizer given by `vocab`, `merges` and `special_tokens` into a token file at
+    `output_path`. Pass `pretoken_ids_path` to look pretokens up in the map saved by
+    training first.
+
+    Returns:
+        int: the number of tokens written.
+    """
+    from cs336_basics.tokenizer import encode_file
+    if isinstance(input_path, list):
+        input_path = [str(path) for path in input_path]
+    else:
+        input_path = str(input_path)
+    return encode_file(input_path, str(output_path), vocab, merges, special_tokens, **kwargs)
+
+
+def run_pretokenize_file(
+    input_path: str | os.PathLike | list[str | os.PathLike],
+    special_tokens: list[str],
+    **kwargs,
+) -> dict[bytes, int]:
+    """Split the corpus at `input_path` (a file, a .gz file, a directory or a list of those)
+    on the special tokens and count its pretokens.
+
+    Returns:
+        dict[bytes, int]: the count of every pretoken, as UTF-8 bytes.
+    """
+    from cs336_basics.pretokenization import pretokenize_file
+    if isinstance(input_path, list):
+        input_path = [str(path) for path in input_path]
+    else:
+        input_path = str(input_path)
+    kwargs.setdefault("num_processes", 2)
+    return pretokenize_file(input_path, special_tokens=special_tokens, **kwargs)
+
+
+def run_merge_drift(
+    merges: list[tuple[bytes, bytes]],
+    reference: list[tuple[bytes, bytes]],
+) -> dict:
+    """Compare `merges` against the `reference` merges of an exact training run.
+
+    Returns:
+        dict: "first_difference", the index of the first merge that differs, and
+            "overlap", the fraction of reference merges found in `merges`.
+    """
+    from cs336_basics.train_bpe import merge_drift
+    return merge_drift(merges, reference)
+
+
+def run_pretokenize(text: str) -> list[str]:
+    """Split `text` (without special tokens) into pretokens with the GPT-2 pretokenization regex.
+
+    Returns:
+        list[str]: the pretokens, in order.
+    """
+    from cs336_basics.pretokenization import pretokenize
+    return pretokenize(text)
+
+
+def run_find_special_tokens(text, special_tokens: list[str], pos: int = 0, endpos: int | None = None) -> list[tuple[int, int]]:
+    """Find the special tokens in `text` (a str, or bytes-like such as an mmap, with the
+    tokens UTF-8 encoded) between `pos` and `endpos`, leftmost-longest.
+
+    Returns:
+        list[tuple[int, int]]: (start, end) of every match, in order.
+    """
+    from cs336_basics.special_tokens import SpecialTokenMatcher
+    return list(SpecialTokenMatcher(special_tokens).finditer(text, pos, endpos))
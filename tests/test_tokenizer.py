@@ -1,15 +1,17 @@
 from __future__ import annotations
 
 import json
+import mmap
 import os
 import resource
 import sys
 
+import numpy as np
 import psutil
 import pytest
 import tiktoken
 
-from .adapters import get_tokenizer
+from .adapters import get_tokenizer, run_encode_file, run_find_special_tokens
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
 VOCAB_PATH = FIXTURES_PATH / "gpt2_vocab.json"
@@ -262,6 +264,24 @@ def test_overlapping_special_tokens():
     assert tokenizer.decode(ids) == test_string
 
 
+def test_special_token_matcher_overlapping_and_prefix_tokens(tmp_path):
+    special_tokens = ["<|a|>", "<|a|><|a|>", "<|ab", "<|ab|>", "é|>"]
+    text = "x<|a|><|a|><|a|>y<|ab|>z<|ab<|é|><|a|"
+    # the longest token wins at every position, a token cut short falls back to its longest prefix token
+    expected = ["<|a|><|a|>", "<|a|>", "<|ab|>", "<|ab", "é|>"]
+    matches = run_find_special_tokens(text, special_tokens)
+    assert [text[start:end] for start, end in matches] == expected
+    assert [text[start:end] for start, end in run_find_special_tokens(text, special_tokens, 2, 22)] == ["<|a|><|a|>", "<|ab"]
+
+    path = tmp_path / "text.txt"
+    path.write_bytes(text.encode("utf-8"))
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        byte_matches = run_find_special_tokens(mm, special_tokens)
+        assert [mm[start:end].decode("utf-8") for start, end in byte_matches] == expected
+    # the same matches at byte offsets
+    assert byte_matches == [(len(text[:start].encode("utf-8")), len(text[:end].encode("utf-8"))) for start, end in matches]
+
+
 def test_address_roundtrip():
     tokenizer = get_tokenizer_from_vocab_merges_path(
         vocab_path=VOCAB_PATH,
@@ -462,3 +482,121 @@ def _encode(tokenizer, text):
     for just this function. We set the memory limit to 1MB.
     """
     return tokenizer.encode(text)
+
+
+def test_encode_pretoken_cache():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    test_string = "the cat and the dog and the bird"
+    ids = tokenizer.encode(test_string)
+    assert tokenizer.encode(test_string) == ids
+    stats = tokenizer.cache_stats()
+    # 8 pretokens per encode, 6 of them distinct: everything else is served from the cache
+    assert stats["misses"] == 6
+    assert stats["hits"] == 2 * 8 - 6
+
+
+def test_duplicate_merge_keeps_lowest_rank():
+    vocab = {i: bytes([i]) for i in range(256)}
+    vocab[256] = b"ab"
+    vocab[257] = b"bc"
+    # (a, b) is listed again after (b, c); its first rank must still win
+    tokenizer = get_tokenizer(vocab, [(b"a", b"b"), (b"b", b"c"), (b"a", b"b")])
+    assert tokenizer.encode("abc") == [256, ord("c")]
+
+
+
+def test_special_token_missing_from_vocab():
+    tokenizer = get_tokenizer_from_vocab_merges_path(vocab_path=VOCAB_PATH, merges_path=MERGES_PATH)
+    vocab = dict(tokenizer.vocab)
+    new_tokenizer = get_tokenizer(vocab, tokenizer.merges, ["<|new|>"])
+    # appended to a copy, the caller's vocab is left alone
+    assert vocab == tokenizer.vocab
+    ids = new_tokenizer.encode("Hello<|new|> world")
+    assert ids == tokenizer.encode("Hello") + [len(vocab)] + tokenizer.encode(" world")
+    assert new_tokenizer.decode(ids) == "Hello<|new|> world"
+
+def test_encode_batches_split_special_tokens():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    test_string = "Héllò hôw <|endoftext|><|endoftext|> are ü? 🙃<|endoftext|>\n\n  the end"
+    # cut every few characters, so the special tokens (and a multi-character whitespace run) span several pieces
+    pieces = [test_string[i : i + 3] for i in range(0, len(test_string), 3)]
+    batches = list(tokenizer.encode_batches(pieces, batch_size=4))
+    assert all(batch.typecode == "H" for batch in batches)
+    assert [token_id for batch in batches for token_id in batch] == tokenizer.encode(test_string)
+    assert list(tokenizer.encode_iterable(pieces)) == tokenizer.encode(test_string)
+
+
+def test_encode_file_matches_encode(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    corpus_path = FIXTURES_PATH / "tinystories_sample.txt"
+    num_tokens = run_encode_file(
+        corpus_path, tmp_path / "tokens.npy", tokenizer.vocab, tokenizer.merges, ["<|endoftext|>"], num_processes=2
+    )
+    tokens = np.load(tmp_path / "tokens.npy", mmap_mode="r")
+    assert tokens.dtype == np.uint16
+    assert len(tokens) == num_tokens
+    assert tokens.tolist() == tokenizer.encode(corpus_path.read_text())
+
+
+
+def test_encode_file_overlapping_special_tokens(tmp_path):
+    special_tokens = ["<|endoftext|>", "<|endoftext|><|endoftext|>"]
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=special_tokens
+    )
+    # runs of two and three tokens, so most cut guesses land inside a run
+    text = "".join(
+        f"Document {i} is here.{'<|endoftext|>' * (2 + i % 2)}" for i in range(40)
+    )
+    corpus_path = tmp_path / "corpus.txt"
+    corpus_path.write_text(text)
+    num_tokens = run_encode_file(
+        corpus_path, tmp_path / "tokens.npy", tokenizer.vocab, tokenizer.merges, special_tokens,
+        num_processes=2, num_chunks=2000,
+    )
+    tokens = np.load(tmp_path / "tokens.npy")
+    assert len(tokens) == num_tokens
+    assert tokens.tolist() == tokenizer.encode(text)
+
+def test_encode_file_wide_vocab(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    # a special token with an id past uint16, so the output has to be uint32
+    vocab = {**tokenizer.vocab, 70000: b"<|wide|>"}
+    special_tokens = ["<|endoftext|>", "<|wide|>"]
+    corpus_path = tmp_path / "corpus.txt"
+    corpus_path.write_text("Hello <|wide|> world!<|endoftext|>Another <|wide|> one.")
+    for output_path in [tmp_path / "tokens.npy", tmp_path / "tokens.bin"]:
+        num_tokens = run_encode_file(corpus_path, output_path, vocab, tokenizer.merges, special_tokens, num_processes=2)
+        if output_path.suffix == ".npy":
+            tokens = np.load(output_path)
+        else:
+            tokens = np.fromfile(output_path, dtype=np.uint32)
+        assert tokens.dtype == np.uint32
+        assert len(tokens) == num_tokens
+        assert tokens.tolist() == get_tokenizer(vocab, tokenizer.merges, special_tokens).encode(corpus_path.read_text())
+        assert 70000 in tokens.tolist()
+
+
+def test_decode_iterable_split_characters():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    test_string = "Héllò hôw are ü? 🙃 これは"
+    ids = tokenizer.encode(test_string)
+    # one id at a time, so the bytes of most non-ASCII characters arrive in several pieces
+    pieces = list(tokenizer.decode_iterable([[token_id] for token_id in ids]))
+    assert "".join(pieces) == test_string
+    assert "�" not in "".join(pieces)
+    assert "".join(tokenizer.decode_iterable(tokenizer.encode_batches([test_string], batch_size=3))) == test_string
@@ -1,9 +1,29 @@
+import gzip
 import json
+import shutil
 import time
+from collections import Counter
 
-from .adapters import run_train_bpe
+import numpy as np
+import pytest
+import regex
+
+from .adapters import (
+    get_instrumentation,
+    get_pool_backend,
+    get_spill_backend,
+    get_submitit_backend,
+    run_encode_file,
+    run_extend_bpe,
+    run_merge_drift,
+    run_pretokenize,
+    run_pretokenize_file,
+    run_train_bpe,
+)
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
 
+GPT2_PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
 
 def test_train_bpe_speed():
     """
@@ -85,4 +105,429 @@ def test_train_bpe_special_tokens(snapshot):
             "vocab_values": set(vocab.values()),
             "merges": merges,
         },
-    )
\ No newline at end of file
+    )
+
+def test_train_bpe_multiple_vocab_sizes():
+    """
+    Training once for several vocab sizes should give the same result as
+    training separately for each of them.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab_sizes = [300, 500, 400]
+    results = run_train_bpe(
+        input_path=input_path,
+        vocab_size=vocab_sizes,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert len(results) == len(vocab_sizes)
+    for vocab_size, (vocab, merges) in zip(vocab_sizes, results):
+        expected_vocab, expected_merges = run_train_bpe(
+            input_path=input_path,
+            vocab_size=vocab_size,
+            special_tokens=["<|endoftext|>"],
+        )
+        assert merges == expected_merges
+        assert vocab == expected_vocab
+
+
+def test_train_bpe_resume_from_checkpoint(tmp_path):
+    """
+    A run resumed from a checkpoint should learn the same merges as a run
+    that was never interrupted.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint_path = tmp_path / "bpe.ckpt"
+    # Stands in for a run that was killed: the last checkpoint is taken after 100 merges
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=50,
+    )
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=50,
+        resume=True,
+    )
+    expected_vocab, expected_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert merges == expected_merges
+    assert vocab == expected_vocab
+
+
+def test_train_bpe_resume_checks_checkpoint(tmp_path):
+    """
+    Resuming from a checkpoint that is already past the requested vocab size
+    should truncate it, and a checkpoint of another corpus must be rejected.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint_path = tmp_path / "bpe.ckpt"
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=50,
+    )
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=checkpoint_path,
+        resume=True,
+    )
+    expected_vocab, expected_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert merges == expected_merges
+    assert vocab == expected_vocab
+
+    with pytest.raises(ValueError):
+        run_train_bpe(
+            input_path=FIXTURES_PATH / "tinystories_sample.txt",
+            vocab_size=500,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=checkpoint_path,
+            resume=True,
+        )
+
+
+def test_train_bpe_parallel_merge():
+    """
+    Running the merge loop over several processes should give exactly the
+    same merges as the single-process loop.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        merge_processes=3,
+    )
+    expected_vocab, expected_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert merges == expected_merges
+    assert vocab == expected_vocab
+
+
+def test_train_bpe_spill_to_disk(tmp_path):
+    """
+    Aggregating the pretoken counts through sorted runs on disk, with a
+    memory budget small enough that every worker spills many times, should
+    give the same merges as counting in memory.
+    """
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        num_processes=2,
+        backend=get_spill_backend(tmp_path / "spill", memory_budget=1 << 12),
+    )
+    expected_vocab, expected_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert merges == expected_merges
+    assert vocab == expected_vocab
+    assert not any((tmp_path / "spill").iterdir())
+
+
+def test_train_bpe_pruning_report():
+    """
+    Dropping rare pretokens may change the merges, but the first exact_merges
+    of them are guaranteed to match the merges of an unpruned run.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    report = {}
+    _, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        max_pretokens=4750,
+        pruning_report=report,
+    )
+    _, expected_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert report["kept_pretokens"] < report["distinct_pretokens"]
+    assert 0 < report["exact_merges"] <= len(merges)
+    assert run_merge_drift(merges, expected_merges)["first_difference"] >= report["exact_merges"]
+
+
+
+def test_train_bpe_resume_pruned_checkpoint(tmp_path):
+    """
+    A run resumed from the checkpoint of a pruned run should give the same
+    merges and pruning report as the uninterrupted pruned run, and resuming it
+    with other pruning settings must be rejected.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    checkpoint_path = tmp_path / "bpe.ckpt"
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        max_pretokens=4750,
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=50,
+    )
+    report = {}
+    _, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        max_pretokens=4750,
+        pruning_report=report,
+        checkpoint_path=checkpoint_path,
+        resume=True,
+    )
+    expected_report = {}
+    _, expected_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        max_pretokens=4750,
+        pruning_report=expected_report,
+    )
+    assert merges == expected_merges
+    assert report == expected_report
+
+    with pytest.raises(ValueError):
+        run_train_bpe(
+            input_path=input_path,
+            vocab_size=500,
+            special_tokens=["<|endoftext|>"],
+            checkpoint_path=checkpoint_path,
+            resume=True,
+        )
+
+def test_extend_bpe():
+    """
+    Extending a smaller tokenizer on the corpus it was trained on should give
+    the same result as training the larger one directly, and extending on a
+    new corpus must keep every existing token ID.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(input_path=input_path, vocab_size=400, special_tokens=["<|endoftext|>"])
+    extended_vocab, extended_merges = run_extend_bpe(vocab, merges, input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+    expected_vocab, expected_merges = run_train_bpe(input_path=input_path, vocab_size=500, special_tokens=["<|endoftext|>"])
+    assert extended_merges == expected_merges
+    assert extended_vocab == expected_vocab
+
+    new_vocab, new_merges = run_extend_bpe(vocab, merges, input_path=FIXTURES_PATH / "tinystories_sample.txt", vocab_size=500, special_tokens=["<|endoftext|>"])
+    assert len(new_vocab) == 500
+    assert new_merges[: len(merges)] == merges
+    assert all(new_vocab[i] == token for i, token in vocab.items())
+
+
+def test_extend_bpe_gpt2_layout():
+    """
+    GPT-2 puts <|endoftext|> after its merge tokens instead of before them.
+    Extending it should learn the same merges as extending the same tokenizer
+    laid out like train_bpe does.
+    """
+    num_merges = 2000
+    gpt2_byte_decoder = {v: k for k, v in gpt2_bytes_to_unicode().items()}
+    with open(FIXTURES_PATH / "gpt2_vocab.json") as f:
+        gpt2_vocab = {index: bytes([gpt2_byte_decoder[c] for c in token]) for token, index in json.load(f).items()}
+    with open(FIXTURES_PATH / "gpt2_merges.txt") as f:
+        merges = [
+            tuple(bytes([gpt2_byte_decoder[c] for c in token]) for token in line.rstrip().split(" "))
+            for line in f
+            if line.strip()
+        ][:num_merges]
+    endoftext = b"<|endoftext|>"
+    # GPT-2 layout: bytes, merges, then <|endoftext|>
+    vocab = {i: gpt2_vocab[i] for i in range(256 + num_merges)}
+    vocab[len(vocab)] = endoftext
+    # train_bpe layout: bytes, <|endoftext|>, then merges
+    rearranged_vocab = {i: gpt2_vocab[i] for i in range(256)}
+    rearranged_vocab[256] = endoftext
+    rearranged_vocab.update({257 + i: gpt2_vocab[256 + i] for i in range(num_merges)})
+
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab_size = len(vocab) + 100
+    extended_vocab, extended_merges = run_extend_bpe(vocab, merges, input_path=input_path, vocab_size=vocab_size, special_tokens=["<|endoftext|>"])
+    expected_vocab, expected_merges = run_extend_bpe(rearranged_vocab, merges, input_path=input_path, vocab_size=vocab_size, special_tokens=["<|endoftext|>"])
+    assert len(extended_vocab) == vocab_size
+    assert extended_merges == expected_merges
+    assert all(extended_vocab[i] == token for i, token in vocab.items())
+    assert all(extended_vocab[i] == expected_vocab[i] for i in range(len(vocab), vocab_size))
+
+
+def test_encode_file_with_pretoken_ids(tmp_path):
+    """
+    The token file written from the pretoken ids saved during training should
+    match a plain BPE encode of the corpus and decode back to the corpus, also
+    across several inputs including a .gz one.
+    """
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        pretoken_ids_path=str(tmp_path / "pretokens.ids"),
+    )
+    with open(input_path, "rb") as f, gzip.open(tmp_path / "corpus.en.gz", "wb") as out:
+        shutil.copyfileobj(f, out)
+    inputs = [str(input_path), str(tmp_path / "corpus.en.gz")]
+    num_tokens = run_encode_file(
+        inputs, tmp_path / "tokens.npy", vocab, merges, ["<|endoftext|>"], pretoken_ids_path=str(tmp_path / "pretokens.ids")
+    )
+    run_encode_file(input_path, tmp_path / "expected.bin", vocab, merges, ["<|endoftext|>"])
+    tokens = np.load(tmp_path / "tokens.npy", mmap_mode="r")
+    expected = np.fromfile(tmp_path / "expected.bin", dtype=np.uint16)
+    assert len(tokens) == num_tokens
+    assert np.array_equal(tokens, np.concatenate([expected, expected]))
+    assert b"".join(vocab[int(token_id)] for token_id in tokens) == 2 * input_path.read_bytes()
+
+
+def test_train_bpe_distributed_pretokenization(tmp_path):
+    """
+    Pretokenizing through submitit jobs (run locally here) should give the
+    same merges as the single-machine pool, also when a job gets a .gz file
+    to cut into blocks.
+    """
+    import submitit
+
+    executor = submitit.LocalExecutor(folder=tmp_path / "logs")
+    executor.update_parameters(timeout_min=10)
+    with open(FIXTURES_PATH / "tinystories_sample.txt", "rb") as f, gzip.open(tmp_path / "tinystories.txt.gz", "wb") as out:
+        shutil.copyfileobj(f, out)
+    vocab, merges = run_train_bpe(
+        input_path=[FIXTURES_PATH / "corpus.en", tmp_path / "tinystories.txt.gz"],
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+        num_processes=2,
+        chunk_size=1 << 14,
+        backend=get_submitit_backend(tmp_path / "shards", executor, num_jobs=2),
+    )
+    expected_vocab, expected_merges = run_train_bpe(
+        input_path=[FIXTURES_PATH / "corpus.en", FIXTURES_PATH / "tinystories_sample.txt"],
+        vocab_size=400,
+        special_tokens=["<|endoftext|>"],
+    )
+    assert merges == expected_merges
+    assert vocab == expected_vocab
+
+
+@pytest.mark.parametrize("window_size", [1, 3, 7])
+def test_pretokenize_file_window_size(window_size):
+    """
+    Streaming the chunks in tiny windows cuts special tokens, pretokens and
+    multi-byte characters at every possible place, and must still count the
+    same pretokens as decoding whole documents.
+    """
+    for input_path in [FIXTURES_PATH / "tinystories_sample.txt", FIXTURES_PATH / "german.txt"]:
+        counts = run_pretokenize_file(input_path, ["<|endoftext|>"], window_size=window_size)
+        expected = run_pretokenize_file(input_path, ["<|endoftext|>"])
+        assert counts == expected
+
+
+def test_pretokenize_file_inputs(tmp_path):
+    """
+    A .gz file (decompressed and cut into blocks for the pool), a directory
+    and a list of inputs should count the same pretokens as the plain files
+    they hold.
+    """
+    special_tokens = ["<|endoftext|>"]
+    plain_paths = [FIXTURES_PATH / "tinystories_sample.txt", FIXTURES_PATH / "corpus.en"]
+    expected = Counter()
+    for path in plain_paths:
+        expected.update(run_pretokenize_file(path, special_tokens))
+
+    gz_path = tmp_path / "corpus" / "b" / "tinystories_sample.txt.gz"
+    gz_path.parent.mkdir(parents=True)
+    gz_path.write_bytes(gzip.compress(plain_paths[0].read_bytes()))
+    (tmp_path / "corpus" / "a").mkdir()
+    shutil.copy(plain_paths[1], tmp_path / "corpus" / "a" / "corpus.en")
+
+    assert run_pretokenize_file(gz_path, special_tokens, chunk_size=512) == run_pretokenize_file(plain_paths[0], special_tokens)
+    assert run_pretokenize_file(tmp_path / "corpus", special_tokens, chunk_size=512) == expected
+    assert run_pretokenize_file([gz_path, plain_paths[1]], special_tokens, parallel_reduce=True) == expected
+
+
+def test_pretokenize_matches_gpt2_pattern():
+    """
+    ASCII text is pretokenized by a faster stdlib pattern, also in the ASCII
+    stretches of documents that contain other characters. Every pair of ASCII
+    characters, every one of them around a contraction, and the same with
+    non-ASCII text next to them must give what the GPT-2 pattern gives.
+    """
+    ascii_chars = [chr(c) for c in range(128)]
+    contractions = ["'s", "'d", "'m", "'t", "'ll", "'ve", "'re", "'x"]
+    texts = [a + b for a in ascii_chars for b in ascii_chars]
+    texts += [a + contraction + b for a in ascii_chars for contraction in contractions for b in ["", "a", " "]]
+    texts += [a + " " + contraction + a for a in ascii_chars for contraction in contractions]
+    assert all(text.isascii() for text in texts)
+    for text in texts:
+        assert run_pretokenize(text) == regex.findall(GPT2_PAT, text), repr(text)
+    for other in ["\u00e9", "\u00a0", "\u3000", "\u4e2d\u6587", "\U0001f600", "\u0663"]:
+        for text in texts[::7]:
+            mixed = f"{text} x{other}y {text}{other} {text}"
+            assert run_pretokenize(mixed) == regex.findall(GPT2_PAT, mixed), repr(mixed)
+
+
+def test_train_bpe_pretokenize_cache(tmp_path):
+    """
+    A second run on the same input and special tokens should load the cached
+    pretoken counts and learn the same merges; changing either misses the cache.
+    """
+    input_path = tmp_path / "corpus.en"
+    shutil.copy(FIXTURES_PATH / "corpus.en", input_path)
+    backend = get_pool_backend(tmp_path / "cache")
+
+    def run(special_tokens):
+        instrumentation = get_instrumentation()
+        _, merges = run_train_bpe(
+            input_path, 500, special_tokens, backend=backend, instrumentation=instrumentation
+        )
+        return merges, instrumentation.report()["pretokenize_cache_hit"]
+
+    merges, hit = run(["<|endoftext|>"])
+    assert not hit
+    cached_merges, hit = run(["<|endoftext|>"])
+    assert hit
+    assert cached_merges == merges
+    assert not run(["<|endoftext|>", "<|pad|>"])[1]
+    with open(input_path, "a") as f:
+        f.write("one more line\n")
+    assert not run(["<|endoftext|>"])[1]
+    assert run(["<|endoftext|>"])[1]
+
+
+def test_train_bpe_instrumentation():
+    """
+    The report of an instrumented run should time every phase of the default
+    backend and give the merge throughput.
+    """
+    instrumentation = get_instrumentation()
+    _, merges = run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        instrumentation=instrumentation,
+    )
+    report = instrumentation.report()
+    assert {"pretokenize", "build_table", "initial_pair_count", "merge_loop"} <= set(report["phases"])
+    assert all(phase["seconds"] >= 0 and phase["peak_rss_mb"] > 0 for phase in report["phases"].values())
+    assert report["num_merges"] == len(merges)
+    assert report["merges_per_second"] == pytest.approx(len(merges) / report["phases"]["merge_loop"]["seconds"])
+    assert report["input_bytes"] == (FIXTURES_PATH / "corpus.en").stat().st_size
+    assert report["total_seconds"] == pytest.approx(sum(phase["seconds"] for phase in report["phases"].values()))